@@ -0,0 +1,280 @@
+import asyncio
+import base64
+import json
+import os
+from contextlib import ExitStack
+
+from main import BlockSpace
+from main6 import IMAGE_PATH, STREAM_CHUNK_BLOCKS, WAL_PATH, FileSystem
+from metadata import FileSystemMetadata, read_superblock
+
+SOCKET_PATH = "block_space.sock"
+DEFAULT_PORT = 8765
+
+class AsyncFileSystem:
+    # Асинхронный интерфейс к FileSystem: дисковые операции выполняются в пуле потоков,
+    # чтения, пришедшие от разных корутин за один шаг цикла событий, объединяются
+    def __init__(self, fs, executor=None):
+        self.fs = fs
+        self.executor = executor if executor is not None else fs.io_pool()
+        self._pending_reads = []
+        self._flush_scheduled = False
+        self.batches = 0
+        self.batched_reads = 0
+
+    async def _run(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(self.executor, function, *args)
+
+    async def read(self, path, offset, length):
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending_reads.append((path, offset, length, future))
+        if not self._flush_scheduled:
+            self._flush_scheduled = True
+            loop.call_soon(self._flush_reads)
+        return await future
+
+    def _flush_reads(self):
+        requests, self._pending_reads = self._pending_reads, []
+        self._flush_scheduled = False
+        self.batches += 1
+        self.batched_reads += len(requests)
+        job = asyncio.get_running_loop().run_in_executor(
+            self.executor, self._read_batch, [request[:3] for request in requests])
+        job.add_done_callback(lambda done: self._resolve(requests, done))
+
+    def _read_batch(self, requests):
+        # Все блоки пакета читаются одним вызовом read_data: соседние блоки разных
+        # запросов попадают в одну серию preadv
+        fs = self.fs
+        paths = sorted({fs.get_full_path(path) for path, _, _ in requests})
+        with ExitStack() as stack:
+            for path in paths:
+                stack.enter_context(fs.locks.get(path).read_locked())
+            plans = []
+            for path, offset, length in requests:
+                try:
+                    if fs.open_file(path).get("compression"):
+                        # Сжатый файл читается отдельно: нужные куски распаковываются
+                        plans.append(fs._read(path, offset, length))
+                    else:
+                        plans.append(fs.read_plan(path, offset, length))
+                except Exception as e:
+                    plans.append(e)
+            blocks = sorted({block for plan in plans if isinstance(plan, tuple) for block in plan[0]})
+            buffer = bytearray(len(blocks) * fs.block_size)
+            if blocks:
+                fs.io.read_data(blocks, buffer)
+        positions = {block: i * fs.block_size for i, block in enumerate(blocks)}
+        results = []
+        for plan in plans:
+            if not isinstance(plan, tuple):
+                results.append(plan)
+                continue
+            plan_blocks, start, size = plan
+            data = bytearray()
+            for block in plan_blocks:
+                data += buffer[positions[block]:positions[block] + fs.block_size]
+            results.append(bytes(data[start:start + size]))
+        return results
+
+    def _resolve(self, requests, done):
+        if done.exception() is not None:
+            for *_, future in requests:
+                if not future.done():
+                    future.set_exception(done.exception())
+            return
+        for (*_, future), result in zip(requests, done.result()):
+            if future.done():
+                continue
+            if isinstance(result, Exception):
+                future.set_exception(result)
+            else:
+                future.set_result(result)
+
+    async def write(self, path, offset, data):
+        return await self._run(self.fs.write, path, offset, data)
+
+    async def create(self, path, size=0):
+        await self._run(self.fs.create, path, size)
+
+    async def delete(self, path):
+        await self._run(self.fs.delete_file, path)
+
+    async def mkdir(self, path):
+        await self._run(self.fs.create_directory, path)
+
+    async def rmdir(self, path):
+        await self._run(self.fs.delete_directory, path)
+
+    async def listdir(self, path):
+        return await self._run(lambda: list(self.fs.directories[self.fs.get_full_path(path)]))
+
+    async def stat(self, path):
+        file = await self._run(self.fs.open_file, path)
+        return {"size": file["size"], "extents": [list(extent) for extent in file["extents"]]}
+
+    async def sync(self):
+        await self._run(self.fs.sync)
+
+    async def stream(self, path, chunk_size=None):
+        # Следующий кусок запрашивается заранее, пока вызывающий обрабатывает текущий
+        if chunk_size is None:
+            chunk_size = STREAM_CHUNK_BLOCKS * self.fs.block_size
+        offset = 0
+        next_chunk = asyncio.ensure_future(self.read(path, offset, chunk_size))
+        while True:
+            chunk = await next_chunk
+            if not chunk:
+                break
+            offset += len(chunk)
+            next_chunk = asyncio.ensure_future(self.read(path, offset, chunk_size))
+            yield chunk
+
+async def handle_request(afs, request):
+    op = request["op"]
+    path = request.get("path", "/")
+    if op == "read":
+        data = await afs.read(path, request.get("offset", 0), request["length"])
+        return base64.b64encode(data).decode("ascii")
+    if op == "write":
+        return await afs.write(path, request.get("offset", 0), base64.b64decode(request["data"]))
+    if op == "create":
+        return await afs.create(path, request.get("size", 0))
+    if op == "delete":
+        return await afs.delete(path)
+    if op == "mkdir":
+        return await afs.mkdir(path)
+    if op == "rmdir":
+        return await afs.rmdir(path)
+    if op == "list":
+        return await afs.listdir(path)
+    if op == "stat":
+        return await afs.stat(path)
+    if op == "sync":
+        return await afs.sync()
+    raise Exception(f"Неизвестная операция: {op}")
+
+async def serve(afs, path=None, host="127.0.0.1", port=DEFAULT_PORT):
+    # Локальный сервер: JSON-строки {"id", "op", ...} -> {"id", "result"} или {"id", "error"}.
+    # Запросы одного соединения выполняются конкурентно, ответы приходят по мере готовности
+    async def client(reader, writer):
+        lock = asyncio.Lock()
+
+        async def answer(request):
+            try:
+                response = {"id": request.get("id"), "result": await handle_request(afs, request)}
+            except Exception as e:
+                response = {"id": request.get("id"), "error": str(e)}
+            async with lock:
+                writer.write(json.dumps(response).encode("utf-8") + b"\n")
+                await writer.drain()
+
+        tasks = set()
+        while line := await reader.readline():
+            task = asyncio.ensure_future(answer(json.loads(line)))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+        if tasks:
+            await asyncio.gather(*tasks)
+        writer.close()
+
+    if path is not None and hasattr(asyncio, "start_unix_server"):
+        if os.path.exists(path):
+            os.remove(path)
+        return await asyncio.start_unix_server(client, path)
+    return await asyncio.start_server(client, host, port)
+
+class AsyncFileSystemClient:
+    # Клиент сервера: несколько процессов работают с одним смонтированным образом
+    def __init__(self, reader, writer):
+        self.reader = reader
+        self.writer = writer
+        self._next_id = 0
+        self._waiting = {}
+        self._listener = asyncio.ensure_future(self._listen())
+
+    @classmethod
+    async def connect(cls, path=None, host="127.0.0.1", port=DEFAULT_PORT):
+        if path is not None and hasattr(asyncio, "open_unix_connection"):
+            reader, writer = await asyncio.open_unix_connection(path)
+        else:
+            reader, writer = await asyncio.open_connection(host, port)
+        return cls(reader, writer)
+
+    async def _listen(self):
+        while line := await self.reader.readline():
+            response = json.loads(line)
+            future = self._waiting.pop(response["id"], None)
+            if future is None or future.done():
+                continue
+            if "error" in response:
+                future.set_exception(Exception(response["error"]))
+            else:
+                future.set_result(response["result"])
+        for future in self._waiting.values():
+            future.set_exception(ConnectionError("Соединение с сервером закрыто."))
+        self._waiting.clear()
+
+    async def call(self, op, **arguments):
+        self._next_id += 1
+        future = asyncio.get_running_loop().create_future()
+        self._waiting[self._next_id] = future
+        self.writer.write(json.dumps(dict(arguments, id=self._next_id, op=op)).encode("utf-8") + b"\n")
+        await self.writer.drain()
+        return await future
+
+    async def read(self, path, offset, length):
+        return base64.b64decode(await self.call("read", path=path, offset=offset, length=length))
+
+    async def write(self, path, offset, data):
+        return await self.call("write", path=path, offset=offset, data=base64.b64encode(data).decode("ascii"))
+
+    async def create(self, path, size=0):
+        await self.call("create", path=path, size=size)
+
+    async def delete(self, path):
+        await self.call("delete", path=path)
+
+    async def mkdir(self, path):
+        await self.call("mkdir", path=path)
+
+    async def rmdir(self, path):
+        await self.call("rmdir", path=path)
+
+    async def listdir(self, path):
+        return await self.call("list", path=path)
+
+    async def stat(self, path):
+        return await self.call("stat", path=path)
+
+    async def sync(self):
+        await self.call("sync")
+
+    async def close(self):
+        self.writer.close()
+        await self.writer.wait_closed()
+        await self._listener
+
+async def main():
+    superblock = read_superblock(IMAGE_PATH)
+    if superblock is None:
+        raise Exception("Образ не отформатирован. Создайте его через main6.py.")
+    with BlockSpace(IMAGE_PATH, superblock["block_size"], superblock["total_blocks"],
+                    wal_filename=WAL_PATH) as block_space:
+        fs = FileSystem(block_space, superblock["block_size"], metadata=FileSystemMetadata.mount(block_space))
+        afs = AsyncFileSystem(fs)
+        server = await serve(afs, SOCKET_PATH)
+        print(f"Сервер запущен: {SOCKET_PATH if hasattr(asyncio, 'start_unix_server') else DEFAULT_PORT}")
+        try:
+            async with server:
+                await server.serve_forever()
+        finally:
+            fs.sync()
+            fs.close()
+
+if __name__ == "__main__":
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,128 @@
+import io
+import json
+import shlex
+import time
+from contextlib import redirect_stdout
+
+# Пакетное выполнение операций над FileSystem.
+# Формат файла: JSON-строки вида {"op": "write", "path": "/a.txt", "offset": 0, "data": "..."}
+# или строки сценария вида: write /a.txt 0 "текст"
+
+SCRIPT_ARGUMENTS = {
+    "create": ["path", "size"],
+    "write": ["path", "offset", "data"],
+    "read": ["path", "offset", "length"],
+    "delete": ["path"],
+    "mkdir": ["path"],
+    "rmdir": ["path"],
+    "import": ["src", "path"],
+    "export": ["path", "dest"],
+    "begin": [],
+    "commit": [],
+    "rollback": [],
+}
+INTEGER_ARGUMENTS = {"size", "offset", "length"}
+
+def parse_line(line):
+    line = line.strip()
+    if not line or line.startswith("#"):
+        return None
+    if line.startswith("{"):
+        return json.loads(line)
+    parts = shlex.split(line)
+    op = parts[0]
+    if op not in SCRIPT_ARGUMENTS:
+        raise Exception(f"Неизвестная операция: {op}")
+    operation = {"op": op}
+    for name, value in zip(SCRIPT_ARGUMENTS[op], parts[1:]):
+        operation[name] = int(value) if name in INTEGER_ARGUMENTS else value
+    return operation
+
+def load_operations(path):
+    with open(path, encoding="utf-8") as f:
+        return [operation for operation in map(parse_line, f) if operation is not None]
+
+def operation_data(operation):
+    if "data_hex" in operation:
+        return bytes.fromhex(operation["data_hex"])
+    data = operation.get("data", "")
+    return data.encode("utf-8") if isinstance(data, str) else bytes(data)
+
+def coalesce(operations):
+    # Подряд идущие записи в один файл, продолжающие друг друга, объединяются в одну
+    merged = []
+    for operation in operations:
+        if operation["op"] == "write":
+            operation = dict(operation, data=operation_data(operation), count=1)
+            operation.pop("data_hex", None)
+            previous = merged[-1] if merged else None
+            if (previous is not None and previous["op"] == "write"
+                    and previous["path"] == operation["path"]
+                    and previous["offset"] + len(previous["data"]) == operation.get("offset", 0)):
+                previous["data"] += operation["data"]
+                previous["count"] += 1
+                continue
+            operation["offset"] = operation.get("offset", 0)
+            operation["data"] = bytearray(operation["data"])
+        merged.append(operation)
+    return merged
+
+def execute(fs, operation):
+    op = operation["op"]
+    if op == "create":
+        fs.create(operation["path"], operation.get("size", 0))
+    elif op == "write":
+        return fs.write(operation["path"], operation.get("offset", 0), operation["data"])
+    elif op == "read":
+        data = fs.read(operation["path"], operation.get("offset", 0), operation.get("length", fs.block_size))
+        return data.decode("utf-8", errors="replace")
+    elif op == "delete":
+        fs.delete_file(operation["path"])
+    elif op == "mkdir":
+        fs.create_directory(operation["path"])
+    elif op == "rmdir":
+        fs.delete_directory(operation["path"])
+    elif op == "import":
+        fs.import_file(operation["src"], operation["path"])
+    elif op == "export":
+        fs.export_file(operation["path"], operation["dest"])
+    elif op == "begin":
+        fs.flush()
+        fs.block_space.start_transaction()
+    elif op == "commit":
+        fs.flush()
+        fs.block_space.commit_transaction()
+    elif op == "rollback":
+        if fs.cache is not None:
+            fs.cache.rollback()
+        else:
+            fs.block_space.rollback_transaction()
+    else:
+        raise Exception(f"Неизвестная операция: {op}")
+    return None
+
+def run_batch(fs, operations):
+    merged = coalesce(operations)
+    results = []
+    errors = 0
+    start = time.perf_counter()
+    with redirect_stdout(io.StringIO()):
+        for operation in merged:
+            try:
+                results.append({"op": operation["op"], "result": execute(fs, operation)})
+            except Exception as e:
+                errors += 1
+                results.append({"op": operation["op"], "error": str(e)})
+        fs.flush()
+    elapsed = time.perf_counter() - start
+    return {
+        "operations": len(operations),
+        "executed": len(merged),
+        "errors": errors,
+        "seconds": elapsed,
+        "ops_per_sec": len(operations) / elapsed if elapsed > 0 else 0.0,
+        "results": results,
+    }
+
+def run_batch_file(fs, path):
+    return run_batch(fs, load_operations(path))
@@ -0,0 +1,198 @@
+import argparse
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import time
+from contextlib import redirect_stdout
+
+from main import BLOCK_SIZES, BlockSpace
+from main6 import FileSystem
+
+# Воспроизводимые замеры BlockSpace и FileSystem. Результат - JSON, который можно
+# сравнивать между запусками: python benchmark.py --output result.json
+
+def timed(function, *args):
+    started = time.perf_counter()
+    result = function(*args)
+    return time.perf_counter() - started, result
+
+def latency_summary(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+    return {
+        'ops': len(samples),
+        'ops_per_sec': len(samples) / sum(samples) if sum(samples) else 0.0,
+        'p50_us': samples[len(samples) // 2] * 1e6,
+        'p99_us': samples[min(len(samples) - 1, len(samples) * 99 // 100)] * 1e6,
+        'max_us': samples[-1] * 1e6,
+    }
+
+def throughput(size, seconds):
+    return size / 2 ** 20 / seconds if seconds else 0.0
+
+def io_benchmark(directory, block_size, data_size, random_ops, rnd):
+    # Последовательная запись и чтение всего пространства сериями по 64 блока,
+    # затем случайные одиночные блоки
+    path = os.path.join(directory, f"io_{block_size}.bin")
+    total_blocks = max(64, data_size // block_size)
+    with BlockSpace(path, block_size, total_blocks, instrument=True) as block_space:
+        blocks = block_space.allocate_blocks(total_blocks)
+        batch = 64
+        data = rnd.randbytes(batch * block_size)
+        buffer = bytearray(batch * block_size)
+
+        def sequential(write):
+            for start in range(0, total_blocks, batch):
+                chunk = blocks[start:start + batch]
+                if write:
+                    block_space.write_data(data[:len(chunk) * block_size], chunk)
+                else:
+                    block_space.read_data(chunk, memoryview(buffer)[:len(chunk) * block_size])
+
+        write_seconds, _ = timed(sequential, True)
+        block_space.sync()
+        read_seconds, _ = timed(sequential, False)
+
+        block = bytearray(block_size)
+        random_writes = []
+        random_reads = []
+        for _ in range(random_ops):
+            target = [rnd.choice(blocks)]
+            random_writes.append(timed(block_space.write_data, data[:block_size], target)[0])
+            random_reads.append(timed(block_space.read_data, target, block)[0])
+        instrumentation = block_space.instrumentation.snapshot()
+    os.remove(path)
+    size = total_blocks * block_size
+    return {
+        'block_size': block_size,
+        'bytes': size,
+        'sequential_write_mb_s': throughput(size, write_seconds),
+        'sequential_read_mb_s': throughput(size, read_seconds),
+        'random_write': latency_summary(random_writes),
+        'random_read': latency_summary(random_reads),
+        'instrumentation': instrumentation,
+    }
+
+def churn_benchmark(directory, total_blocks, iterations, rnd):
+    # Чередование выделения и освобождения блоков случайного размера
+    path = os.path.join(directory, "churn.bin")
+    with BlockSpace(path, 1024, total_blocks, instrument=True) as block_space:
+        owned = []
+        allocations = []
+        releases = []
+        failed = 0
+        for _ in range(iterations):
+            if owned and (rnd.random() < 0.45 or block_space.free_extents.free_count < 64):
+                extents = owned.pop(rnd.randrange(len(owned)))
+                releases.append(timed(block_space.release_extents, extents)[0])
+            else:
+                seconds, extents = timed(block_space.allocate_extents, rnd.randint(1, 64))
+                allocations.append(seconds)
+                if extents:
+                    owned.append(extents)
+                else:
+                    failed += 1
+        info = block_space.block_space_info()
+    os.remove(path)
+    return {
+        'iterations': iterations,
+        'allocate': latency_summary(allocations),
+        'release': latency_summary(releases),
+        'failed_allocations': failed,
+        'free_extents': len(info['free_block_chains']),
+        'free_blocks': info['free_blocks'],
+    }
+
+def tree_benchmark(directory, directories, files_per_directory, rnd):
+    # Большое дерево каталогов: создание, листинг и поиск по имени
+    path = os.path.join(directory, "tree.bin")
+    with BlockSpace(path, 1024, 1024, instrument=True) as block_space:
+        fs = FileSystem(block_space, 1024)
+        names = []
+        started = time.perf_counter()
+        for d in range(directories):
+            fs.create_directory(f"/dir{d}")
+            for f in range(files_per_directory):
+                name = f"/dir{d}/file_{rnd.randrange(10 ** 9):09d}_{f}.txt"
+                fs.create(name)
+                names.append(name)
+        create_seconds = time.perf_counter() - started
+        fs.current_dir = "/dir0"
+        list_seconds, _ = timed(fs.list_directory)
+        fs.current_dir = "/"
+        searches = [timed(fs.search_files, os.path.basename(rnd.choice(names))[5:12])[0] for _ in range(200)]
+        fs.close()
+    os.remove(path)
+    entries = directories * (files_per_directory + 1)
+    return {
+        'entries': entries,
+        'create_per_sec': entries / create_seconds if create_seconds else 0.0,
+        'list_directory_seconds': list_seconds,
+        'search': latency_summary(searches),
+    }
+
+def transaction_benchmark(directory, transactions, blocks_per_transaction, group_commit, rnd):
+    # Короткие транзакции через журнал упреждающей записи
+    path = os.path.join(directory, f"tx_{group_commit}.bin")
+    wal_path = os.path.join(directory, f"tx_{group_commit}.wal")
+    with BlockSpace(path, 4096, 4096, wal_filename=wal_path, group_commit=group_commit,
+                    instrument=True) as block_space:
+        blocks = block_space.allocate_blocks(4096)
+        data = rnd.randbytes(blocks_per_transaction * 4096)
+        commits = []
+        started = time.perf_counter()
+        for _ in range(transactions):
+            block_space.start_transaction()
+            block_space.write_data(data, rnd.sample(blocks, blocks_per_transaction))
+            commits.append(timed(block_space.commit_transaction)[0])
+        block_space.flush_commits()
+        seconds = time.perf_counter() - started
+    os.remove(path)
+    os.remove(wal_path)
+    return {
+        'group_commit': group_commit,
+        'transactions': transactions,
+        'transactions_per_sec': transactions / seconds if seconds else 0.0,
+        'commit': latency_summary(commits),
+    }
+
+def run_benchmarks(quick=False, seed=0):
+    rnd = random.Random(seed)
+    scale = 1 if quick else 4
+    results = {}
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, 'w') as devnull, redirect_stdout(devnull):
+        results['io'] = [io_benchmark(directory, block_size, 2 ** 20 * 2 * scale, 200 * scale, rnd)
+                         for block_size in BLOCK_SIZES]
+        results['churn'] = churn_benchmark(directory, 8192 * scale, 5000 * scale, rnd)
+        results['tree'] = tree_benchmark(directory, 20 * scale, 250 * scale, rnd)
+        results['transactions'] = [transaction_benchmark(directory, 200 * scale, 8, group_commit, rnd)
+                                   for group_commit in (1, 16)]
+    return {
+        'seed': seed,
+        'quick': quick,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'vector_io': hasattr(os, 'preadv'),
+        'results': results,
+    }
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности BlockSpace и FileSystem")
+    parser.add_argument("--output", help="файл для JSON-результата (по умолчанию - стандартный вывод)")
+    parser.add_argument("--quick", action="store_true", help="уменьшенные объёмы для быстрой проверки")
+    parser.add_argument("--seed", type=int, default=0)
+    arguments = parser.parse_args()
+    report = run_benchmarks(arguments.quick, arguments.seed)
+    if arguments.output:
+        with open(arguments.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+    else:
+        json.dump(report, sys.stdout, ensure_ascii=False, indent=2)
+        print()
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,176 @@
+import threading
+from collections import OrderedDict
+
+from main import block_runs
+
+class BlockCache:
+    # Буферный кеш блоков с вытеснением LRU и отложенной записью грязных блоков
+    def __init__(self, block_space, capacity):
+        if capacity <= 0:
+            raise ValueError("Размер кеша должен быть положительным.")
+        self.block_space = block_space
+        self.block_size = block_space.block_size
+        self.capacity = capacity
+        self.blocks = OrderedDict()
+        self.dirty = set()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.writebacks = 0
+        # Блоки, подгруженные упреждающим чтением и ещё не запрошенные
+        self.prefetched = set()
+        self.prefetched_blocks = 0
+        self.prefetch_hits = 0
+        self.prefetch_wasted = 0
+        self.lock = threading.RLock()
+        self._write_generation = 0
+
+    def read_data(self, block_indices, buffer, verify=None):
+        view = memoryview(buffer)
+        size = self.block_size
+        missing = []
+        with self.lock:
+            generation = self._write_generation
+            for i, block_index in enumerate(block_indices):
+                cached = self.blocks.get(block_index)
+                if cached is None:
+                    self.misses += 1
+                    missing.append((i, block_index))
+                else:
+                    self.hits += 1
+                    if block_index in self.prefetched:
+                        self.prefetched.discard(block_index)
+                        self.prefetch_hits += 1
+                    self.blocks.move_to_end(block_index)
+                    view[i * size:(i + 1) * size] = cached
+
+        if missing:
+            # Промахи читаются с диска без удержания блокировки кеша
+            loaded = bytearray(len(missing) * size)
+            self.block_space.read_data([block_index for _, block_index in missing], loaded, verify)
+            with self.lock:
+                # Если во время чтения были записи, прочитанное с диска в кеш не кладётся
+                keep = generation == self._write_generation
+                for j, (i, block_index) in enumerate(missing):
+                    cached = self.blocks.get(block_index)
+                    if cached is None:
+                        cached = loaded[j * size:(j + 1) * size]
+                        if keep:
+                            self._store(block_index, cached, False)
+                    view[i * size:(i + 1) * size] = cached
+
+    def generation(self):
+        # Номер поколения записей и сбросов: берётся до решения об упреждающем чтении
+        with self.lock:
+            return self._write_generation
+
+    def prefetch(self, block_indices, generation):
+        # Упреждающее чтение: отсутствующие в кеше блоки читаются с диска и кладутся чистыми,
+        # если после generation в кеш ничего не писалось и ничего не сбрасывалось
+        size = self.block_size
+        with self.lock:
+            if generation != self._write_generation:
+                return 0
+            missing = [block_index for block_index in block_indices if block_index not in self.blocks]
+        if not missing:
+            return 0
+        loaded = bytearray(len(missing) * size)
+        self.block_space.read_data(missing, loaded)
+        stored = 0
+        with self.lock:
+            if generation != self._write_generation:
+                return 0
+            for j, block_index in enumerate(missing):
+                if block_index not in self.blocks:
+                    self._store(block_index, loaded[j * size:(j + 1) * size], False)
+                    self.prefetched.add(block_index)
+                    stored += 1
+            self.prefetched_blocks += stored
+        return stored
+
+    def write_data(self, data, block_indices):
+        with self.lock:
+            self._write_data(data, block_indices)
+
+    def _write_data(self, data, block_indices):
+        size = self.block_size
+        data_length = len(data)
+        for i, block_index in enumerate(block_indices):
+            if not self.block_space.is_allocated(block_index):
+                continue
+            start = i * size
+            chunk = data[start:start + size] if start < data_length else bytes(size)
+            if len(chunk) < size:
+                # Неполный блок дописывается поверх текущего содержимого
+                block = bytearray(size)
+                self.read_data([block_index], block)
+                block[:len(chunk)] = chunk
+            else:
+                block = bytearray(chunk)
+            self._store(block_index, block, True)
+
+    def _store(self, block_index, block, dirty):
+        self.blocks[block_index] = block
+        self.blocks.move_to_end(block_index)
+        if dirty:
+            self.dirty.add(block_index)
+            self._write_generation += 1
+        while len(self.blocks) > self.capacity:
+            victim, victim_data = self.blocks.popitem(last=False)
+            self.evictions += 1
+            if victim in self.prefetched:
+                self.prefetched.discard(victim)
+                self.prefetch_wasted += 1
+            if victim in self.dirty:
+                self.dirty.discard(victim)
+                self.writebacks += 1
+                self.block_space.write_data(victim_data, [victim])
+
+    def flush(self):
+        with self.lock:
+            # Грязные блоки записываются непрерывными сериями
+            for start, count in block_runs(sorted(self.dirty)):
+                blocks = list(range(start, start + count))
+                self.block_space.write_data(b''.join(self.blocks[block] for block in blocks), blocks)
+                self.writebacks += count
+            self.dirty.clear()
+
+    def commit(self):
+        with self.lock:
+            self.flush()
+            self.block_space.commit_transaction()
+
+    def rollback(self):
+        with self.lock:
+            # Кеш мог получить блоки из отменяемой транзакции, поэтому сбрасывается целиком
+            self.blocks.clear()
+            self.dirty.clear()
+            self.prefetched.clear()
+            self.block_space.rollback_transaction()
+
+    def invalidate(self, block_indices):
+        with self.lock:
+            for block_index in block_indices:
+                self.blocks.pop(block_index, None)
+                self.dirty.discard(block_index)
+                self.prefetched.discard(block_index)
+            # Незавершённое упреждающее чтение не должно вернуть в кеш освобождённые блоки
+            self._write_generation += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {
+                'capacity': self.capacity,
+                'cached_blocks': len(self.blocks),
+                'dirty_blocks': len(self.dirty),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+                'writebacks': self.writebacks,
+                'hit_rate': self.hits / lookups if lookups else 0.0,
+                'prefetched_blocks': self.prefetched_blocks,
+                'prefetch_hits': self.prefetch_hits,
+                'prefetch_wasted': self.prefetch_wasted,
+                'prefetch_hit_rate': self.prefetch_hits / self.prefetched_blocks if self.prefetched_blocks else 0.0
+            }
\ No newline at end of file
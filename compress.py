@@ -0,0 +1,38 @@
+import lzma
+import struct
+import zlib
+
+# Сжатый файл хранится кусками по CHUNK_SIZE байт исходных данных. Каждый кусок -
+# один непрерывный экстент: заголовок (длина сжатых данных, длина исходных) и данные.
+# Длина сжатых данных 0 означает, что кусок не сжался и хранится как есть
+
+CHUNK_SIZE = 64 * 1024
+CHUNK_HEADER = struct.Struct('<II')
+
+# Номер алгоритма хранится в байте флагов инода
+COMPRESSION_NONE = 0
+COMPRESSION_ZLIB = 1
+COMPRESSION_LZMA = 2
+CODECS = {
+    COMPRESSION_ZLIB: (lambda data: zlib.compress(data, 6), zlib.decompress),
+    COMPRESSION_LZMA: (lzma.compress, lzma.decompress),
+}
+CODEC_NAMES = {"zlib": COMPRESSION_ZLIB, "lzma": COMPRESSION_LZMA}
+
+def chunk_blocks(block_size):
+    return max(1, CHUNK_SIZE // block_size)
+
+def compress_chunk(data, codec):
+    # Функция уровня модуля, чтобы её можно было выполнять в пуле процессов
+    data = bytes(data)
+    packed = CODECS[codec][0](data)
+    if len(packed) >= len(data):
+        return CHUNK_HEADER.pack(0, len(data)) + data
+    return CHUNK_HEADER.pack(len(packed), len(data)) + packed
+
+def decompress_chunk(stored, codec):
+    packed_length, length = CHUNK_HEADER.unpack_from(stored)
+    body = memoryview(stored)[CHUNK_HEADER.size:]
+    if not packed_length:
+        return bytes(body[:length])
+    return CODECS[codec][1](body[:packed_length])
@@ -0,0 +1,152 @@
+import hashlib
+import struct
+import threading
+
+from main import extent_blocks
+
+# Запись таблицы дедупликации: физический блок, число ссылок, хеш содержимого
+DEDUP_RECORD = struct.Struct('<II16s')
+
+def block_digest(data):
+    return hashlib.blake2b(data, digest_size=16).digest()
+
+class DedupStore:
+    # Дедупликация блоков по содержимому между FileSystem и BlockSpace (или кешем).
+    # Одинаковые полные блоки хранятся один раз; у общего блока счётчик ссылок больше 1,
+    # и запись в него выполняется копированием в новый блок
+    def __init__(self, block_space, io=None):
+        self.block_space = block_space
+        self.io = io if io is not None else block_space
+        self.block_size = block_space.block_size
+        self.index = {}
+        self.digests = {}
+        # Только для общих блоков; у остальных выделенных блоков одна ссылка
+        self.refs = {}
+        self.shared_references = 0
+        self.lock = threading.Lock()
+        self.dirty = False
+        block_space.dedup = self
+
+    def references(self, block_index):
+        return self.refs.get(block_index, 1)
+
+    def _index(self, block_index, digest):
+        self.index[digest] = block_index
+        self.digests[block_index] = digest
+
+    def _unindex(self, block_index):
+        digest = self.digests.pop(block_index, None)
+        if digest is not None and self.index.get(digest) == block_index:
+            del self.index[digest]
+
+    def _drop(self, block_index, freed):
+        references = self.references(block_index)
+        if references > 1:
+            self.shared_references -= 1
+            if references == 2:
+                del self.refs[block_index]
+            else:
+                self.refs[block_index] = references - 1
+        else:
+            self._unindex(block_index)
+            freed.append(block_index)
+
+    def _free(self, blocks):
+        if not blocks:
+            return
+        if self.io is not self.block_space:
+            self.io.invalidate(blocks)
+        self.block_space.release_blocks(blocks)
+
+    def write_blocks(self, data, block_indices):
+        # Запись полных блоков data в блоки файла. Возвращает новый список физических
+        # блоков: блок с уже известным содержимым заменяется ссылкой на существующий
+        size = self.block_size
+        view = memoryview(data)
+        result = []
+        written = []
+        freed = []
+        with self.lock:
+            for i, block_index in enumerate(block_indices):
+                chunk = view[i * size:(i + 1) * size]
+                if len(chunk) < size:
+                    chunk = bytes(chunk) + bytes(size - len(chunk))
+                digest = block_digest(chunk)
+                existing = self.index.get(digest)
+                if existing == block_index:
+                    result.append(block_index)
+                    continue
+                self.dirty = True
+                if existing is not None:
+                    self.refs[existing] = self.references(existing) + 1
+                    self.shared_references += 1
+                    self._drop(block_index, freed)
+                    result.append(existing)
+                    continue
+                if self.references(block_index) > 1:
+                    # Копирование при записи: общий блок остаётся у остальных файлов
+                    copy = self.block_space.allocate_blocks(1)
+                    if not copy:
+                        raise Exception("Недостаточно свободных блоков для копирования при записи.")
+                    self._drop(block_index, freed)
+                    block_index = copy[0]
+                else:
+                    self._unindex(block_index)
+                self._index(block_index, digest)
+                written.append((block_index, chunk))
+                result.append(block_index)
+            if written:
+                self.io.write_data(b''.join(chunk for _, chunk in written), [block for block, _ in written])
+            self._free(freed)
+        return result
+
+    def relocate(self, moves):
+        # Перенос неразделяемых блоков на новые места (дефрагментация): хеши переходят к новым блокам
+        with self.lock:
+            for old, new in moves:
+                digest = self.digests.pop(old, None)
+                if digest is not None:
+                    self._index(new, digest)
+                    self.dirty = True
+
+    def release_blocks(self, block_indices):
+        freed = []
+        with self.lock:
+            for block_index in block_indices:
+                self._drop(block_index, freed)
+            if block_indices:
+                self.dirty = True
+            self._free(freed)
+        return freed
+
+    def release_extents(self, extents):
+        return self.release_blocks(list(extent_blocks(extents)))
+
+    def ratio(self):
+        # Логические блоки на физический: 1.0 - дедупликация ничего не сэкономила
+        used = self.block_space.total_blocks - self.block_space.free_extents.free_count
+        return (used + self.shared_references) / used if used else 1.0
+
+    def stats(self):
+        with self.lock:
+            return {
+                'indexed_blocks': len(self.digests),
+                'shared_blocks': len(self.refs),
+                'saved_blocks': self.shared_references,
+                'dedup_ratio': self.ratio()
+            }
+
+    def serialize(self):
+        with self.lock:
+            self.dirty = False
+            return b''.join(DEDUP_RECORD.pack(block_index, self.references(block_index), digest)
+                            for block_index, digest in sorted(self.digests.items()))
+
+    def load(self, data):
+        with self.lock:
+            for offset in range(0, len(data) - DEDUP_RECORD.size + 1, DEDUP_RECORD.size):
+                block_index, references, digest = DEDUP_RECORD.unpack_from(data, offset)
+                self._index(block_index, digest)
+                if references > 1:
+                    self.refs[block_index] = references
+                    self.shared_references += references - 1
@@ -0,0 +1,172 @@
+import threading
+import time
+
+from main import block_runs, extent_blocks
+
+# Дефрагментация на ходу: блоки файла переносятся в один непрерывный участок, данные
+# и новый инод фиксируются одной транзакцией, старые блоки освобождаются после неё
+
+def fragmentation_report(fs):
+    # Фрагментация свободного места (число свободных экстентов и доля самого большого
+    # из них) и файлов (число несмежных участков) среди загруженных файлов
+    block_space = fs.block_space
+    free = list(block_space.free_extents)
+    free_blocks = sum(count for _, count in free)
+    largest = max((count for _, count in free), default=0)
+    files = list(dict.values(fs.files))
+    runs = [len(file_runs(file)) for file in files]
+    tail = free[-1][1] if free and sum(free[-1]) == block_space.total_blocks else 0
+    return {
+        'free_extents': len(free),
+        'free_blocks': free_blocks,
+        'largest_free_run': largest,
+        'free_space_fragmentation': 1 - largest / free_blocks if free_blocks else 0.0,
+        'tail_free_blocks': tail,
+        'files': len(files),
+        'fragmented_files': sum(1 for count in runs if count > 1),
+        'runs_per_file': sum(runs) / len(runs) if runs else 0.0,
+    }
+
+def file_runs(file):
+    # Непрерывные участки файла на диске; незаписанные куски сжатого файла не учитываются
+    return block_runs(extent_blocks(extent for extent in file["extents"] if extent[1]))
+
+class Defragmenter(threading.Thread):
+    # Перенос идёт по одному файлу под его блокировкой записи; скорость копирования
+    # ограничена rate_mb МБ/с, чтобы не мешать обычной нагрузке
+    def __init__(self, fs, rate_mb=8.0, interval=300.0):
+        super().__init__(daemon=True)
+        if rate_mb <= 0:
+            raise ValueError("Скорость переноса должна быть положительной.")
+        self.fs = fs
+        self.rate_mb = rate_mb
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.moved_files = 0
+        self.moved_blocks = 0
+        self.skipped_files = 0
+        self._throttle_started = None
+        self._moved_bytes = 0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.run_pass()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def _throttle(self, size):
+        if self._throttle_started is None:
+            self._throttle_started = time.perf_counter()
+        self._moved_bytes += size
+        ahead = self._moved_bytes / (self.rate_mb * 2 ** 20) - (time.perf_counter() - self._throttle_started)
+        if ahead > 0:
+            self.stop_event.wait(ahead)
+
+    def _paths(self):
+        # Все файлы дерева: при ленивой загрузке метаданных они подгружаются здесь
+        return [path for path in self.fs.walk_paths() if path in self.fs.files]
+
+    def run_pass(self, compact=False):
+        # Сначала самые фрагментированные файлы; при compact - файлы из конца пространства
+        fs = self.fs
+        paths = self._paths()
+        if compact:
+            paths.sort(key=lambda path: max(extent_blocks(file_runs(fs.files[path])), default=-1), reverse=True)
+        else:
+            paths.sort(key=lambda path: len(file_runs(fs.files[path])), reverse=True)
+        for path in paths:
+            if self.stop_event.is_set():
+                break
+            self.move_file(path, compact)
+        return fragmentation_report(fs)
+
+    def move_file(self, path, compact=False):
+        fs = self.fs
+        block_space = fs.block_space
+        with fs.locks.get(path).write_locked():
+            file = fs.files.get(path)
+            if file is None:
+                return False
+            runs = file_runs(file)
+            total = sum(count for _, count in runs)
+            if not total or (len(runs) == 1 and not compact):
+                return False
+            old_blocks = list(extent_blocks(runs))
+            if fs.dedup is not None and any(fs.dedup.references(block) > 1 for block in old_blocks):
+                # Общий блок принадлежит нескольким файлам и не переносится
+                self.skipped_files += 1
+                return False
+            with block_space.lock:
+                start = block_space.free_extents.find(total, best_fit=False)
+            if start is not None and len(runs) == 1 and start >= runs[0][0]:
+                return False
+            target = block_space.allocate_blocks(total, best_fit=False) if start is not None else []
+            if not target:
+                self.skipped_files += 1
+                return False
+
+            fs.flush()
+            buffer = bytearray(total * block_space.block_size)
+            fs.io.read_data(old_blocks, buffer)
+            extents = []
+            position = target[0]
+            for start, count in file["extents"]:
+                extents.append((position, count) if count else (0, 0))
+                position += count
+            if not file.get("compression"):
+                extents = [(target[0], total)]
+
+            old_extents = file["extents"]
+            started = not block_space.transaction_active
+            if started:
+                block_space.start_transaction()
+            try:
+                block_space.write_data(buffer, target)
+                file["extents"] = extents
+                if fs.metadata is not None:
+                    fs.metadata.update_file(file)
+            except Exception:
+                file["extents"] = old_extents
+                if started:
+                    block_space.rollback_transaction()
+                block_space.release_range(target[0], total)
+                raise
+            if started:
+                block_space.commit_transaction()
+            if fs.cache is not None:
+                # Новые блоки записаны мимо кеша
+                fs.cache.invalidate(target)
+            if fs.dedup is not None:
+                fs.dedup.relocate(zip(old_blocks, target))
+            fs.release_extents(runs)
+        self.moved_files += 1
+        self.moved_blocks += total
+        self._throttle(total * block_space.block_size)
+        return True
+
+    def compact(self):
+        # Перенос файлов к началу пространства и отрезание освободившегося хвоста образа
+        fs = self.fs
+        block_space = fs.block_space
+        self.run_pass(compact=True)
+        # Хвост выбирается и отрезается под блокировкой распределителя, чтобы его не заняли
+        # между проверкой и усечением; новый размер сохраняется только после усечения
+        with block_space.lock:
+            free = list(block_space.free_extents)
+            if not free or sum(free[-1]) != block_space.total_blocks:
+                return fragmentation_report(fs)
+            total_blocks = max(free[-1][0], 1)
+            block_space.shrink(total_blocks)
+        if fs.metadata is not None:
+            block_space.start_transaction()
+            try:
+                fs.metadata.resize(total_blocks)
+            except Exception:
+                block_space.rollback_transaction()
+                raise
+            block_space.commit_transaction()
+        return fragmentation_report(fs)
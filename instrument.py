@@ -0,0 +1,60 @@
+import functools
+import threading
+import time
+
+# Необязательный сбор статистики операций: число вызовов, переданные байты,
+# суммарное время и гистограмма задержек по степеням двойки микросекунд
+
+HISTOGRAM_BUCKETS = 32
+
+class Instrumentation:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.operations = {}
+
+    def record(self, name, seconds, size=0):
+        bucket = min(int(seconds * 1e6).bit_length(), HISTOGRAM_BUCKETS - 1)
+        with self.lock:
+            stats = self.operations.get(name)
+            if stats is None:
+                stats = self.operations[name] = {'count': 0, 'bytes': 0, 'seconds': 0.0,
+                                                 'histogram': [0] * HISTOGRAM_BUCKETS}
+            stats['count'] += 1
+            stats['bytes'] += size
+            stats['seconds'] += seconds
+            stats['histogram'][bucket] += 1
+
+    def snapshot(self):
+        # Гистограмма в виде {"<N us": число вызовов} только для непустых корзин
+        with self.lock:
+            result = {}
+            for name, stats in sorted(self.operations.items()):
+                result[name] = {
+                    'count': stats['count'],
+                    'bytes': stats['bytes'],
+                    'seconds': stats['seconds'],
+                    'histogram': {f"<{1 << bucket} us": count
+                                  for bucket, count in enumerate(stats['histogram']) if count}
+                }
+            return result
+
+    def reset(self):
+        with self.lock:
+            self.operations.clear()
+
+def instrumented(name, size=None):
+    # Метод, время которого учитывается в self.instrumentation, если сбор включён.
+    # size(self, *args) - число переданных байт
+    def decorator(method):
+        @functools.wraps(method)
+        def wrapper(self, *args, **kwargs):
+            instrumentation = self.instrumentation
+            if instrumentation is None:
+                return method(self, *args, **kwargs)
+            started = time.perf_counter()
+            result = method(self, *args, **kwargs)
+            instrumentation.record(name, time.perf_counter() - started,
+                                   size(self, *args) if size is not None else 0)
+            return result
+        return wrapper
+    return decorator
@@ -1,37 +1,635 @@
+import functools
+import mmap
+import os
+import sys
+import threading
+import time
+import zlib
+from array import array
+from bisect import bisect_left, bisect_right, insort
+from itertools import accumulate, repeat
+
+from instrument import Instrumentation, instrumented
+from locks import RWLock
+from wal import WriteAheadLog
+
+# Векторный ввод-вывод (preadv/pwritev) доступен не на всех платформах
+HAS_VECTOR_IO = hasattr(os, 'preadv') and hasattr(os, 'pwritev')
+try:
+    IOV_MAX = os.sysconf('SC_IOV_MAX')
+except (AttributeError, ValueError, OSError):
+    IOV_MAX = 1024
+if IOV_MAX <= 0:
+    IOV_MAX = 1024
+
+# Число блоков пространства на лист дерева поиска first-fit в FreeExtentIndex
+FIRST_FIT_GROUP = 64
+
+# Признак в числе блоков экстента: один блок, повторённый count раз подряд
+# (общий блок файла при дедупликации, например нулевой)
+REPEATED = 1 << 31
+
+# Число зафиксированных в журнале блоков, после которого они переносятся в основной файл.
+# До этого они читаются из wal_pending, и каждая фиксация стоит одного fsync журнала
+CHECKPOINT_BLOCKS = 1024
 
 MIN_BLOCK_SIZE = 2 ** 10
 MAX_BLOCK_SIZE = 2 ** 16
 BLOCK_SIZES = [2 ** i for i in range(10, 17)]
 
-class FreeBlockChain:
-    def __init__(self, start_block, block_count):
-        self.start_block = start_block
-        self.block_count = block_count
-        self.next = None
-
-    def __str__(self):
-        return f"({self.start_block}, {self.block_count})"
+def synchronized(method):
+    # Метод BlockSpace, выполняемый под общей блокировкой распределителя
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+def block_runs(block_indices):
+    # Разбиение списка блоков на непрерывные серии (start, count); подряд идущие
+    # одинаковые блоки сворачиваются в экстент с признаком REPEATED
+    runs = []
+    for block in block_indices:
+        if runs:
+            start, count = runs[-1]
+            if count & REPEATED:
+                if start == block:
+                    runs[-1][1] += 1
+                    continue
+            elif start + count == block:
+                runs[-1][1] += 1
+                continue
+            elif start + count - 1 == block:
+                if count > 1:
+                    runs[-1][1] -= 1
+                    runs.append([block, REPEATED | 2])
+                else:
+                    runs[-1][1] = REPEATED | 2
+                continue
+        runs.append([block, 1])
+    return [(start, count) for start, count in runs]
+
+def extent_blocks(extents):
+    for start, count in extents:
+        if count & REPEATED:
+            yield from repeat(start, count & ~REPEATED)
+        else:
+            yield from range(start, start + count)
+
+def extent_length(count):
+    return count & ~REPEATED
+
+def slice_extent(start, count, low, high):
+    # Логические блоки low..high-1 экстента
+    if count & REPEATED:
+        return start, REPEATED | (high - low) if high - low > 1 else 1
+    return start + low, high - low
+
+def append_extents(extents, new_extents):
+    # Добавление экстентов в конец списка со слиянием соседних; повторы одного
+    # блока сливаются в экстент с признаком REPEATED
+    for start, count in new_extents:
+        if extents:
+            last_start, last_count = extents[-1]
+            if not (last_count | count) & REPEATED and last_start + last_count == start:
+                extents[-1] = (last_start, last_count + count)
+                continue
+            if last_start == start and (last_count & REPEATED or last_count == 1) and (count & REPEATED or count == 1):
+                extents[-1] = (start, REPEATED | (extent_length(last_count) + extent_length(count)))
+                continue
+        extents.append((start, count))
+    return extents
+
+def split_extents(extents, at):
+    # Экстенты логических блоков до at и начиная с at: нужный экстент находится
+    # двоичным поиском по накопленным длинам, список блоков не разворачивается
+    ends = list(accumulate(extent_length(count) for _, count in extents))
+    i = bisect_right(ends, at)
+    if i == len(extents):
+        return list(extents), []
+    start, count = extents[i]
+    length = extent_length(count)
+    offset = at - (ends[i] - length)
+    if not offset:
+        return extents[:i], extents[i:]
+    return (extents[:i] + [slice_extent(start, count, 0, offset)],
+            [slice_extent(start, count, offset, length)] + extents[i + 1:])
+
+def replace_blocks(extents, first, block_indices):
+    # Экстенты файла после замены его блоков начиная с first на block_indices
+    head, rest = split_extents(extents, first)
+    tail = split_extents(rest, len(block_indices))[1]
+    return append_extents(append_extents(head, block_runs(block_indices)), tail)
+
+class FreeExtentIndex:
+    # Свободные экстенты (start, count), упорядоченные по началу и по размеру.
+    # Оба массива поддерживаются через bisect, поиск подходящего экстента - O(log n).
+    # Для first-fit - дерево максимумов по участкам из FIRST_FIT_GROUP блоков: лист хранит
+    # наибольший экстент, начинающийся в участке, узел - максимум по потомкам
+    def __init__(self):
+        self.starts = []
+        self.counts = {}
+        self.by_size = []
+        self.free_count = 0
+        self.leaves = 1
+        self.tree = array('I', [0, 0])
+
+    def __len__(self):
+        return len(self.starts)
+
+    def __iter__(self):
+        for start in self.starts:
+            yield start, self.counts[start]
+
+    def _insert(self, start, count):
+        insort(self.starts, start)
+        insort(self.by_size, (count, start))
+        self.counts[start] = count
+        self.free_count += count
+        self._update(start // FIRST_FIT_GROUP)
+
+    def _remove(self, start):
+        count = self.counts.pop(start)
+        del self.starts[bisect_left(self.starts, start)]
+        del self.by_size[bisect_left(self.by_size, (count, start))]
+        self.free_count -= count
+        self._update(start // FIRST_FIT_GROUP)
+        return count
+
+    def _group_starts(self, group):
+        low = bisect_left(self.starts, group * FIRST_FIT_GROUP)
+        high = bisect_left(self.starts, (group + 1) * FIRST_FIT_GROUP, low)
+        return self.starts[low:high]
+
+    def _update(self, group):
+        if group >= self.leaves:
+            # Дерево растёт вдвое и перестраивается целиком
+            while group >= self.leaves:
+                self.leaves *= 2
+            self.tree = array('I', bytes(8 * self.leaves))
+            for start in self.starts:
+                node = self.leaves + start // FIRST_FIT_GROUP
+                self.tree[node] = max(self.tree[node], self.counts[start])
+            for node in range(self.leaves - 1, 0, -1):
+                self.tree[node] = max(self.tree[2 * node], self.tree[2 * node + 1])
+            return
+        tree = self.tree
+        node = self.leaves + group
+        tree[node] = max((self.counts[start] for start in self._group_starts(group)), default=0)
+        node //= 2
+        while node:
+            tree[node] = max(tree[2 * node], tree[2 * node + 1])
+            node //= 2
+
+    def _first_fit(self, num_blocks):
+        # Спуск к самому левому листу с экстентом не меньше num_blocks: O(log n + FIRST_FIT_GROUP)
+        tree = self.tree
+        if tree[1] < num_blocks:
+            return None
+        node = 1
+        while node < self.leaves:
+            node *= 2
+            if tree[node] < num_blocks:
+                node += 1
+        for start in self._group_starts(node - self.leaves):
+            if self.counts[start] >= num_blocks:
+                return start
+
+    def largest(self):
+        return self.by_size[-1][0] if self.by_size else 0
+
+    def find(self, num_blocks, best_fit=True):
+        i = bisect_left(self.by_size, (num_blocks, -1))
+        if i == len(self.by_size):
+            return None
+        if best_fit:
+            return self.by_size[i][1]
+        # first-fit: самый левый из экстентов достаточного размера
+        return self._first_fit(num_blocks)
+
+    def take(self, start, num_blocks):
+        count = self._remove(start)
+        if count < num_blocks:
+            self._insert(start, count)
+            raise ValueError("Экстент меньше запрошенного размера.")
+        if count > num_blocks:
+            self._insert(start + num_blocks, count - num_blocks)
+        return start
+
+    def allocate(self, num_blocks, best_fit=True):
+        start = self.find(num_blocks, best_fit)
+        if start is None:
+            return None
+        return self.take(start, num_blocks)
+
+    def free(self, start, count):
+        # Освобождение диапазона целиком со слиянием с соседями слева и справа
+        i = bisect_right(self.starts, start)
+        if i > 0:
+            left = self.starts[i - 1]
+            left_count = self.counts[left]
+            if left + left_count > start:
+                raise ValueError("Диапазон уже свободен.")
+            if left + left_count == start:
+                self._remove(left)
+                start, count = left, count + left_count
+        end = start + count
+        i = bisect_left(self.starts, start)
+        if i < len(self.starts):
+            right = self.starts[i]
+            if right < end:
+                raise ValueError("Диапазон уже свободен.")
+            if right == end:
+                count += self._remove(right)
+        self._insert(start, count)
 
 class BlockSpace:
-    def __init__(self, filename, block_size, total_blocks):
+    def __init__(self, filename, block_size, total_blocks, use_mmap=False, best_fit=True,
+                 wal_filename=None, group_commit=1, checksums=True, verify_reads=True, instrument=False):
         self.filename = filename
         self.block_size = block_size
         self.total_blocks = total_blocks
-        self.allocated_blocks = {}
-        self.free_blocks_head = None
-        self.transaction_cache = {}
-        self.transaction_active = False
+        self.use_mmap = use_mmap
+        self.best_fit = best_fit
+        # Один бит на блок: 1 - блок выделен
+        self.block_bitmap = bytearray((total_blocks + 7) // 8)
+        self.free_extents = FreeExtentIndex()
+        # Транзакция у каждого потока своя; распределитель и журнал - под общей блокировкой
+        self._local = threading.local()
+        self.lock = threading.RLock()
+        self._seek_lock = threading.Lock()
+        self.wal_filename = wal_filename
+        self.group_commit = group_commit
+        self.wal = None
+        # Зафиксированные в журнале, но ещё не перенесённые в основной файл блоки
+        self.wal_pending = {}
+        self.last_txid = 0
+        self._file = None
+        self._mmap = None
+        self._view = None
+        # Ввод-вывод через отображение - под чтением, пересоздание и закрытие отображения - под записью
+        self._map_lock = RWLock()
+        self._zero_block = memoryview(bytes(block_size))
+        # Слой дедупликации, если он подключён (см. dedup.DedupStore)
+        self.dedup = None
+        # Счётчики и гистограммы задержек операций, если сбор включён
+        self.instrumentation = Instrumentation() if instrument else None
+        # CRC32 каждого блока на диске. Сумма блока известна, если он записан в этом сеансе,
+        # загружен из метаданных или уже прочитан; неизвестные суммы не проверяются
+        self.verify_reads = verify_reads
+        if checksums:
+            self.checksums = array('I', [zlib.crc32(self._zero_block)]) * total_blocks
+            self.checksum_known = bytearray(total_blocks)
+        else:
+            self.checksums = None
+            self.checksum_known = None
+        self.verified_blocks = 0
+        self.checksum_errors = 0
+        self.checksum_seconds = 0.0
 
         self.initialize_free_blocks()
-
+        self.open()
+
+    @property
+    def transaction_active(self):
+        return getattr(self._local, 'active', False)
+
+    @transaction_active.setter
+    def transaction_active(self, value):
+        self._local.active = value
+
+    @property
+    def transaction_cache(self):
+        cache = getattr(self._local, 'cache', None)
+        if cache is None:
+            cache = self._local.cache = {}
+        return cache
+
+    @property
+    def pending_releases(self):
+        # Экстенты, освобождаемые после фиксации транзакции потока: до неё
+        # на них ещё ссылаются сохранённые на диске метаданные
+        released = getattr(self._local, 'released', None)
+        if released is None:
+            released = self._local.released = []
+        return released
+
+    def __enter__(self):
+        self.open()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def open(self):
+        # Один дескриптор на всё время жизни объекта вместо open() на каждую операцию
+        if self._file is not None:
+            return
+        mode = 'r+b' if os.path.exists(self.filename) else 'w+b'
+        self._file = open(self.filename, mode, buffering=0)
+        size = self.total_blocks * self.block_size
+        self._file.seek(0, os.SEEK_END)
+        if self._file.tell() < size:
+            # Дописанные нулевые блоки имеют сумму нулевого блока
+            if self.checksums is not None:
+                first = -(-self._file.tell() // self.block_size)
+                self.checksum_known[first:] = b'\x01' * (self.total_blocks - first)
+            self._file.truncate(size)
+        if self.use_mmap and size > 0:
+            self._mmap = mmap.mmap(self._file.fileno(), size)
+            self._view = memoryview(self._mmap)
+        if self.wal_filename is not None:
+            self.wal = WriteAheadLog(self.wal_filename, self.group_commit)
+            self.recover()
+
+    def close(self):
+        if self._file is None:
+            return
+        # Отображение закрывается первым: если срезы из read_range ещё не освобождены,
+        # закрытие не выполняется и объект остаётся полностью рабочим
+        with self._map_lock.write_locked():
+            self._unmap()
+        if self.wal is not None:
+            self.flush_commits()
+            self.wal.close()
+            self.wal = None
+        self._file.close()
+        self._file = None
+
+    def _unmap(self):
+        # Вызывается под записью _map_lock; при ошибке отображение остаётся прежним
+        if self._mmap is None:
+            return
+        self._mmap.flush()
+        self._view.release()
+        self._view = None
+        try:
+            self._mmap.close()
+        except BufferError:
+            self._view = memoryview(self._mmap)
+            raise BufferError("Срезы отображения, полученные из read_range, не освобождены.") from None
+        self._mmap = None
+
+    def flush(self):
+        with self._map_lock.read_locked():
+            if self._mmap is not None:
+                self._mmap.flush()
+                return
+        if self._file is not None:
+            self._file.flush()
+
+    def sync(self):
+        self.flush()
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+
+    def _write_at(self, block_index, data):
+        self._transfer(block_index, [memoryview(data)], True)
+
+    def _read_at(self, block_index, buffer, verify=True):
+        self._transfer(block_index, [memoryview(buffer)], False, verify)
+
+    def _transfer(self, start_block, pieces, writing, check=True):
+        # Один непрерывный участок файла, собранный из нескольких буферов:
+        # один вызов preadv/pwritev без промежуточных копий.
+        # check: при записи обновить контрольные суммы блоков, при чтении - проверить их
+        all_pieces = pieces
+        offset = start_block * self.block_size
+        if self._view is None or not self._map_transfer(offset, pieces, writing):
+            self._file_transfer(offset, pieces, writing)
+        if not check or self.checksums is None:
+            return
+        if writing:
+            self._record_checksums(start_block, all_pieces)
+        else:
+            bad = self._verify_checksums(start_block, all_pieces)
+            if bad:
+                self.checksum_errors += len(bad)
+                raise OSError(f"Контрольная сумма не совпала для блоков: {bad}")
+
+    def _file_transfer(self, offset, pieces, writing):
+        if HAS_VECTOR_IO:
+            fd = self._file.fileno()
+            while pieces:
+                done = os.pwritev(fd, pieces, offset) if writing else os.preadv(fd, pieces, offset)
+                if done <= 0:
+                    break
+                offset += done
+                while pieces and done >= len(pieces[0]):
+                    done -= len(pieces[0])
+                    pieces = pieces[1:]
+                if pieces and done:
+                    pieces = [pieces[0][done:]] + pieces[1:]
+        else:
+            with self._seek_lock:
+                self._file.seek(offset)
+                for piece in pieces:
+                    if writing:
+                        self._file.write(piece)
+                    else:
+                        self._file.readinto(piece)
+
+    def _map_transfer(self, offset, pieces, writing):
+        # Копирование через отображение; False, если его уже закрыли
+        with self._map_lock.read_locked():
+            view = self._view
+            if view is None:
+                return False
+            for piece in pieces:
+                if writing:
+                    view[offset:offset + len(piece)] = piece
+                else:
+                    piece[:] = view[offset:offset + len(piece)]
+                offset += len(piece)
+        return True
+
+    def _block_checksums(self, pieces):
+        # CRC32 полных блоков непрерывного участка и длина неполного последнего блока
+        size = self.block_size
+        checksums = []
+        crc = filled = 0
+        for piece in pieces:
+            position = 0
+            while position < len(piece):
+                step = min(size - filled, len(piece) - position)
+                crc = zlib.crc32(piece[position:position + step], crc)
+                filled += step
+                position += step
+                if filled == size:
+                    checksums.append(crc)
+                    crc = filled = 0
+        return checksums, filled
+
+    def _record_checksums(self, start_block, pieces):
+        started = time.perf_counter()
+        checksums, partial = self._block_checksums(pieces)
+        self.checksums[start_block:start_block + len(checksums)] = array('I', checksums)
+        self.checksum_known[start_block:start_block + len(checksums)] = b'\x01' * len(checksums)
+        if partial:
+            # Неполный блок: сумма считается по его содержимому на диске
+            block_index = start_block + len(checksums)
+            buffer = bytearray(self.block_size)
+            self._transfer(block_index, [memoryview(buffer)], False, False)
+            self.checksums[block_index] = zlib.crc32(buffer)
+            self.checksum_known[block_index] = 1
+        self.checksum_seconds += time.perf_counter() - started
+
+    def _verify_checksums(self, start_block, pieces):
+        # Номера блоков с несовпавшей суммой; неизвестные суммы запоминаются при первом чтении
+        started = time.perf_counter()
+        checksums, _ = self._block_checksums(pieces)
+        bad = []
+        for block_index, crc in enumerate(checksums, start_block):
+            if not self.checksum_known[block_index]:
+                self.checksums[block_index] = crc
+                self.checksum_known[block_index] = 1
+            elif self.checksums[block_index] != crc:
+                bad.append(block_index)
+        self.verified_blocks += len(checksums)
+        self.checksum_seconds += time.perf_counter() - started
+        return bad
+
+    def scrub_range(self, start_block, block_count):
+        # Проверка диапазона без исключения: список повреждённых блоков. Несовпавший блок
+        # перечитывается, чтобы не принять за порчу одновременную с чтением запись
+        buffer = memoryview(bytearray(block_count * self.block_size))
+        self._transfer(start_block, [buffer], False, False)
+        damaged = []
+        for block_index in self._verify_checksums(start_block, [buffer]):
+            block = memoryview(bytearray(self.block_size))
+            self._transfer(block_index, [block], False, False)
+            if self._verify_checksums(block_index, [block]):
+                damaged.append(block_index)
+        self.checksum_errors += len(damaged)
+        return damaged
+
+    @synchronized
+    def checksum_bytes(self):
+        # Суммы всех блоков (little-endian) с учётом ещё не записанных в файл блоков
+        # журнала и транзакции - в том виде, в каком они окажутся на диске
+        snapshot = array('I', self.checksums)
+        for blocks in (self.wal_pending, self.transaction_cache):
+            for block_index, data in blocks.items():
+                snapshot[block_index] = zlib.crc32(data)
+        if self.pending_releases:
+            # Освобождаемые блоки обнуляются
+            for block_index in extent_blocks(self.pending_releases):
+                snapshot[block_index] = zlib.crc32(self._zero_block)
+        if sys.byteorder == 'big':
+            snapshot.byteswap()
+        return snapshot.tobytes()
+
+    @synchronized
+    def load_checksums(self, data, first_block=0):
+        # Сохранённые суммы блоков начиная с first_block; суммы блоков, записанных
+        # в этом сеансе (например, при восстановлении из журнала), не заменяются
+        saved = array('I')
+        saved.frombytes(bytes(data[:self.total_blocks * saved.itemsize]))
+        if sys.byteorder == 'big':
+            saved.byteswap()
+        for block_index in range(first_block, min(len(saved), self.total_blocks)):
+            if not self.checksum_known[block_index]:
+                self.checksums[block_index] = saved[block_index]
+                self.checksum_known[block_index] = 1
+
+    def _disk_runs(self, pairs, partial_position=None):
+        # pairs: (номер блока, позиция в буфере вызывающего). Результат - серии
+        # подряд идущих на диске блоков со списком позиций буфера для каждой
+        runs = []
+        for block_index, position in sorted(pairs):
+            if (runs and runs[-1][0] + len(runs[-1][1]) == block_index
+                    and len(runs[-1][1]) < IOV_MAX and runs[-1][1][-1] != partial_position):
+                runs[-1][1].append(position)
+            else:
+                runs.append((block_index, [position]))
+        return runs
+
+    def _pieces(self, view, positions, data_length=None):
+        # Срезы буфера для серии; соседние позиции объединяются в один срез,
+        # блоки за концом записываемых данных заменяются нулевым блоком
+        size = self.block_size
+        pieces = []
+        group = []
+        for position in positions + [None]:
+            if position is not None and data_length is not None and position * size >= data_length:
+                if group:
+                    pieces.append(view[group[0] * size:(group[-1] + 1) * size])
+                    group = []
+                pieces.append(self._zero_block)
+                continue
+            if group and (position is None or position != group[-1] + 1):
+                pieces.append(view[group[0] * size:(group[-1] + 1) * size])
+                group = []
+            if position is not None:
+                group.append(position)
+        return pieces
+
+    @instrumented('read_range', lambda self, start_block, block_count, *args: block_count * self.block_size)
+    def read_range(self, start_block, block_count, buffer=None, verify=None):
+        # Непрерывный диапазон блоков. В режиме mmap без буфера возвращается
+        # срез отображения без копирования; его нужно освободить (release) до close().
+        if verify is None:
+            verify = self.verify_reads
+        offset = start_block * self.block_size
+        length = block_count * self.block_size
+        # Незаписанные в файл блоки транзакции или журнала читаются поблочно
+        overlay = self._overlaid(start_block, block_count)
+        if buffer is None:
+            view = self._map_slice(offset, length) if not overlay else None
+            if view is not None:
+                if verify and self.checksums is not None:
+                    bad = self._verify_checksums(start_block, [view])
+                    if bad:
+                        self.checksum_errors += len(bad)
+                        raise OSError(f"Контрольная сумма не совпала для блоков: {bad}")
+                return view
+            buffer = bytearray(length)
+        if overlay:
+            self.read_data(range(start_block, start_block + block_count), buffer, verify)
+        else:
+            self._read_at(start_block, memoryview(buffer)[:length], verify)
+        return buffer
+
+    def _map_slice(self, offset, length):
+        with self._map_lock.read_locked():
+            if self._view is None:
+                return None
+            return self._view[offset:offset + length]
+
+    def _overlaid(self, start_block, block_count):
+        # Есть ли в диапазоне блоки, которые ещё не записаны в основной файл
+        end = start_block + block_count
+        for blocks in (self.transaction_cache, self.wal_pending):
+            if not blocks:
+                continue
+            if block_count <= len(blocks):
+                if any(block_index in blocks for block_index in range(start_block, end)):
+                    return True
+            elif any(start_block <= block_index < end for block_index in list(blocks)):
+                return True
+        return False
+
+    @instrumented('write_range', lambda self, start_block, data: len(data))
+    def write_range(self, start_block, data):
+        data = memoryview(data)
+        if self.transaction_active:
+            self.write_data(data, list(range(start_block, start_block + -(-len(data) // self.block_size))))
+            return
+        self.flush_commits()
+        self._write_at(start_block, data)
+
+    def _write_merged(self, blocks):
+        # Запись набора полных блоков отсортированными непрерывными сериями:
+        # соседние блоки уходят на диск одной операцией записи
+        for start, count in block_runs(sorted(blocks)):
+            for chunk in range(start, start + count, IOV_MAX):
+                end = min(chunk + IOV_MAX, start + count)
+                self._transfer(chunk, [memoryview(blocks[block]) for block in range(chunk, end)], True)
+
+    @synchronized
     def block_space_info(self):
-        free_chains = []
-        free_count = 0
-        current = self.free_blocks_head
-        while current:
-            free_count += current.block_count
-            free_chains.append(str(current))
-            current = current.next
+        free_chains = [f"({start}, {count})" for start, count in self.free_extents]
+        free_count = self.free_extents.free_count
 
         return {
             'block_size': self.block_size,
@@ -39,137 +637,322 @@ class BlockSpace:
             'free_blocks': free_count,
             'free_block_chains': free_chains,
             'allocated_blocks': self.total_blocks - free_count,
-            'service_memory_size': len(self.allocated_blocks) * self.block_size,
-            'transaction_cache_size': sum(len(data) for data in self.transaction_cache.values())
+            'service_memory_size': self.metadata_memory_size(),
+            'transaction_cache_size': sum(len(data) for data in self.transaction_cache.values()),
+            'wal_pending_blocks': len(self.wal_pending),
+            'checksum_verified_blocks': self.verified_blocks,
+            'checksum_errors': self.checksum_errors,
+            'checksum_seconds': self.checksum_seconds,
+            'dedup_ratio': self.dedup.ratio() if self.dedup is not None else 1.0,
+            'instrumentation': self.instrumentation.snapshot() if self.instrumentation is not None else None
         }
 
+    def metadata_memory_size(self):
+        extents = self.free_extents
+        checksums = 0
+        if self.checksums is not None:
+            checksums = sys.getsizeof(self.checksums) + sys.getsizeof(self.checksum_known)
+        return (sys.getsizeof(self.block_bitmap)
+                + checksums
+                + sys.getsizeof(extents.starts)
+                + sys.getsizeof(extents.by_size)
+                + sys.getsizeof(extents.counts)
+                + sys.getsizeof(extents.tree)
+                + sum(sys.getsizeof(item) for item in extents.by_size))
+
+    def is_allocated(self, block_index):
+        if block_index < 0 or block_index >= self.total_blocks:
+            return False
+        return bool(self.block_bitmap[block_index >> 3] & (1 << (block_index & 7)))
+
+    def _mark_range(self, start, count, allocated):
+        end = start + count
+        bitmap = self.block_bitmap
+        while start < end and start & 7:
+            if allocated:
+                bitmap[start >> 3] |= 1 << (start & 7)
+            else:
+                bitmap[start >> 3] &= ~(1 << (start & 7)) & 0xFF
+            start += 1
+        full_bytes = (end - start) >> 3
+        if full_bytes:
+            bitmap[start >> 3:(start >> 3) + full_bytes] = (b'\xff' if allocated else b'\x00') * full_bytes
+            start += full_bytes << 3
+        while start < end:
+            if allocated:
+                bitmap[start >> 3] |= 1 << (start & 7)
+            else:
+                bitmap[start >> 3] &= ~(1 << (start & 7)) & 0xFF
+            start += 1
+
     def initialize_free_blocks(self):
-        self.free_blocks_head = FreeBlockChain(0, self.total_blocks)
+        self.block_bitmap = bytearray((self.total_blocks + 7) // 8)
+        self.free_extents = FreeExtentIndex()
+        if self.total_blocks > 0:
+            self.free_extents.free(0, self.total_blocks)
+
+    @synchronized
+    def load_bitmap(self, bitmap):
+        # Восстановление индекса свободных экстентов по сохранённой битовой карте
+        self.block_bitmap = bytearray(bitmap[:len(self.block_bitmap)])
+        self.free_extents = FreeExtentIndex()
+        run_start = None
+        for byte_index, byte in enumerate(self.block_bitmap):
+            if (byte == 0 and run_start is not None) or (byte == 0xFF and run_start is None):
+                continue
+            for bit in range(8):
+                block = (byte_index << 3) + bit
+                if block >= self.total_blocks:
+                    break
+                if byte >> bit & 1:
+                    if run_start is not None:
+                        self.free_extents.free(run_start, block - run_start)
+                        run_start = None
+                elif run_start is None:
+                    run_start = block
+        if run_start is not None:
+            self.free_extents.free(run_start, self.total_blocks - run_start)
 
     def start_transaction(self):
         if self.transaction_active:
             print("Транзакция уже активна.")
             return
         self.transaction_cache.clear()
+        self.pending_releases.clear()
         self.transaction_active = True
         print("Транзакция начата.")
 
+    @instrumented('commit_transaction')
+    @synchronized
     def commit_transaction(self):
         if not self.transaction_active:
             print("Нет активной транзакции для фиксации.")
             return
 
-        with open(self.filename, 'r+b') as f:
-            for index, data in self.transaction_cache.items():
-                f.seek(index * self.block_size)
-                f.write(data)
+        if self.wal is not None:
+            self.last_txid += 1
+            synced = self.wal.append_transaction(self.last_txid, self.transaction_cache)
+            self.wal_pending.update(self.transaction_cache)
+            if synced and len(self.wal_pending) >= CHECKPOINT_BLOCKS:
+                self.checkpoint()
+        else:
+            self._write_merged(self.transaction_cache)
 
         self.transaction_cache.clear()
         self.transaction_active = False
+        released = list(self.pending_releases)
+        self.pending_releases.clear()
+        self.release_extents(released)
         print("Транзакция зафиксирована.")
 
+    @synchronized
+    def checkpoint(self):
+        # Перенос зафиксированных в журнале блоков в основной файл и очистка журнала
+        if self.wal is None or not self.wal_pending:
+            return
+        self._write_merged(self.wal_pending)
+        self.sync()
+        self.wal.reset()
+        self.wal_pending.clear()
+
+    def flush_commits(self):
+        # Принудительный fsync журнала для накопленной группы транзакций
+        if self.wal is None or not self.wal_pending:
+            return
+        with self.lock:
+            self.wal.sync()
+            self.checkpoint()
+
+    @synchronized
+    def recover(self):
+        committed = self.wal.replay()
+        for txid, blocks in committed:
+            self.wal_pending.update(blocks)
+            self.last_txid = max(self.last_txid, txid)
+        if self.wal_pending:
+            self.checkpoint()
+            print(f"Восстановлено транзакций из журнала: {len(committed)}.")
+        else:
+            self.wal.reset()
+
     def rollback_transaction(self):
         if not self.transaction_active:
             print("Нет активной транзакции для отката.")
             return
 
         self.transaction_cache.clear()
+        self.pending_releases.clear()
         self.transaction_active = False
         print("Транзакция отменена.")
 
+    @instrumented('write_data', lambda self, data, block_indices: len(data))
     def write_data(self, data, block_indices):
+        # Данные для i-го блока списка берутся со смещения i * block_size
         data_length = len(data)
         if self.transaction_active:
-            for block_index in block_indices:
-                if block_index in self.allocated_blocks:
-                    start = (block_index - block_indices[0]) * self.block_size
+            for i, block_index in enumerate(block_indices):
+                if self.is_allocated(block_index):
+                    start = i * self.block_size
                     end = start + self.block_size
-                    block_data = data[start:end] if start < data_length else b'\x00' * self.block_size
+                    block_data = bytes(data[start:end]) if start < data_length else b'\x00' * self.block_size
+                    if len(block_data) < self.block_size:
+                        # В кеше транзакции хранятся только полные блоки
+                        block = bytearray(self.block_size)
+                        self.read_data([block_index], block)
+                        block[:len(block_data)] = block_data
+                        block_data = bytes(block)
                     self.transaction_cache[block_index] = block_data
-            print(f"Данные записаны в кеш для блоков: {block_indices}")
         else:
-            with open(self.filename, 'r+b') as f:
-                for block_index in block_indices:
-                    if block_index in self.allocated_blocks:
-                        start = (block_index - block_indices[0]) * self.block_size
-                        end = start + self.block_size
-                        block_data = data[start:end] if start < data_length else b'\x00' * self.block_size
-                        f.seek(block_index * self.block_size)
-                        f.write(block_data)
-            print(f"Данные записаны в файл для блоков: {block_indices}")
-
-    def read_data(self, block_indices, buffer):
-        with open(self.filename, 'rb') as f:
-            for i, block_index in enumerate(block_indices):
-                if block_index in self.transaction_cache:
-                    buffer[i * self.block_size:(i + 1) * self.block_size] = self.transaction_cache[block_index]
-                else:
-                    f.seek(block_index * self.block_size)
-                    buffer[i * self.block_size:(i + 1) * self.block_size] = f.read(self.block_size)
-
-    def allocate_blocks(self, num_blocks):
+            # Прямая запись не должна обгонять ещё не перенесённые из журнала блоки
+            self.flush_commits()
+            view = memoryview(data)
+            pairs = [(block_index, i) for i, block_index in enumerate(block_indices) if self.is_allocated(block_index)]
+            # Неполный последний блок завершает серию, иначе следующие данные сместятся
+            partial = data_length // self.block_size if data_length % self.block_size else None
+            for start, positions in self._disk_runs(pairs, partial):
+                self._transfer(start, self._pieces(view, positions, data_length), True)
+
+    @instrumented('read_data', lambda self, block_indices, *args: len(block_indices) * self.block_size)
+    def read_data(self, block_indices, buffer, verify=None):
+        # verify=False отключает проверку контрольных сумм для этого чтения
+        if verify is None:
+            verify = self.verify_reads
+        view = memoryview(buffer)
+        size = self.block_size
+        pairs = []
+        for i, block_index in enumerate(block_indices):
+            cached = self.transaction_cache.get(block_index)
+            if cached is None:
+                cached = self.wal_pending.get(block_index)
+            if cached is not None:
+                view[i * size:(i + 1) * size] = cached
+            else:
+                pairs.append((block_index, i))
+        for start, positions in self._disk_runs(pairs):
+            self._transfer(start, self._pieces(view, positions), False, verify)
+
+    @instrumented('allocate_blocks')
+    @synchronized
+    def allocate_blocks(self, num_blocks, best_fit=None):
         if num_blocks <= 0:
             return []
 
-        allocated = []
-
-        current_chain = self.free_blocks_head
-        while current_chain and num_blocks > 0:
-            if current_chain.block_count >= num_blocks:
-                allocated.extend(range(current_chain.start_block, current_chain.start_block + num_blocks))
-                if current_chain.block_count > num_blocks:
-
-                    current_chain.start_block += num_blocks
-                    current_chain.block_count -= num_blocks
-                else:
+        if best_fit is None:
+            best_fit = self.best_fit
+        start = self.free_extents.allocate(num_blocks, best_fit)
+        if start is None:
+            return []
 
-                    if current_chain == self.free_blocks_head:
-                        self.free_blocks_head = current_chain.next
-                    else:
-                        prev_chain.next = current_chain.next
+        self._mark_range(start, num_blocks, True)
+        return list(range(start, start + num_blocks))
+
+    @synchronized
+    def reserve_range(self, start, count):
+        # Выделение блоков по заданному адресу (служебные области образа)
+        self.free_extents.take(start, count)
+        self._mark_range(start, count, True)
+        return list(range(start, start + count))
+
+    @instrumented('allocate_extents')
+    @synchronized
+    def allocate_extents(self, num_blocks):
+        # Выделение num_blocks блоков минимальным числом фрагментов.
+        # Возвращает список экстентов (start, count) или [], если места не хватает.
+        if num_blocks <= 0 or self.free_extents.free_count < num_blocks:
+            return []
 
+        extents = []
+        remaining = num_blocks
+        while remaining > 0:
+            largest = self.free_extents.largest()
+            if largest >= remaining:
+                start = self.free_extents.allocate(remaining, True)
+                extents.append((start, remaining))
                 break
+            start = self.free_extents.by_size[-1][1]
+            self.free_extents.take(start, largest)
+            extents.append((start, largest))
+            remaining -= largest
 
-            prev_chain = current_chain
-            current_chain = current_chain.next
+        extents.sort()
+        for start, count in extents:
+            self._mark_range(start, count, True)
 
-        for block in allocated:
-            self.allocated_blocks[block] = bytearray(self.block_size)
+        return extents
 
-        return allocated
+    @instrumented('release_extents')
+    @synchronized
+    def release_extents(self, extents):
+        for start, count in extents:
+            self.release_range(start, count)
 
+    @instrumented('release_blocks')
+    @synchronized
     def release_blocks(self, block_indices):
-        for block_index in block_indices:
-            if block_index in self.allocated_blocks:
-                del self.allocated_blocks[block_index]
-
-                current_chain = self.free_blocks_head
-                while current_chain:
-                    if current_chain.start_block == block_index + 1:
-                        current_chain.start_block -= 1
-                        current_chain.block_count += 1
-                        break
-                    elif current_chain.start_block + current_chain.block_count == block_index:
-                        current_chain.block_count += 1
-                        break
-                    elif current_chain.start_block > block_index:
-                        new_chain = FreeBlockChain(block_index, 1)
-                        new_chain.next = current_chain
-                        if current_chain == self.free_blocks_head:
-                            self.free_blocks_head = new_chain
-                        else:
-                            prev_chain.next = new_chain
-                        break
-
-                    prev_chain = current_chain
-                    current_chain = current_chain.next
-
-
-                self.clear_block(block_index)
+        released = sorted(block for block in set(block_indices) if self.is_allocated(block))
+        for start, count in block_runs(released):
+            self.release_range(start, count)
+
+    def release_on_commit(self, extents):
+        # Освобождение после фиксации текущей транзакции, без неё - сразу
+        if not self.transaction_active:
+            self.release_extents(extents)
+            return
+        self.pending_releases.extend(extents)
+
+    def bitmap_after_commit(self):
+        # Битовая карта, в которой блоки, освобождаемые при фиксации, уже свободны
+        if not self.pending_releases:
+            return self.block_bitmap
+        bitmap = bytearray(self.block_bitmap)
+        for block_index in extent_blocks(self.pending_releases):
+            bitmap[block_index >> 3] &= ~(1 << (block_index & 7)) & 0xFF
+        return bitmap
+
+    @synchronized
+    def release_range(self, start, count):
+        self.free_extents.free(start, count)
+        self._mark_range(start, count, False)
+        self.clear_range(start, count)
+
+    @synchronized
+    def shrink(self, total_blocks):
+        # Отрезание свободного хвоста пространства и усечение файла образа
+        if total_blocks >= self.total_blocks:
+            return
+        tail = self.free_extents.starts[-1] if self.free_extents.starts else None
+        if tail is None or tail > total_blocks or tail + self.free_extents.counts[tail] != self.total_blocks:
+            raise ValueError("Отрезаемый хвост пространства занят.")
+        self.flush_commits()
+        with self._map_lock.write_locked():
+            # Отображение закрывается до изменения состояния: если срезы из read_range
+            # ещё не освобождены, пространство остаётся прежним
+            mapped = self._mmap is not None
+            self._unmap()
+            self.free_extents._remove(tail)
+            if tail < total_blocks:
+                self.free_extents._insert(tail, total_blocks - tail)
+            self.total_blocks = total_blocks
+            del self.block_bitmap[(total_blocks + 7) // 8:]
+            if self.checksums is not None:
+                del self.checksums[total_blocks:]
+                del self.checksum_known[total_blocks:]
+            size = total_blocks * self.block_size
+            self._file.truncate(size)
+            if mapped:
+                self._mmap = mmap.mmap(self._file.fileno(), size)
+                self._view = memoryview(self._mmap)
+
+    def clear_range(self, start, count):
+        self.flush_commits()
+        zeros = memoryview(bytes(min(count, 256) * self.block_size))
+        while count > 0:
+            step = min(count, 256)
+            self._write_at(start, zeros[:step * self.block_size])
+            start += step
+            count -= step
 
     def clear_block(self, block_index):
-        with open(self.filename, 'r+b') as f:
-            f.seek(block_index * self.block_size)
-            f.write(b'\x00' * self.block_size)
+        self._write_at(block_index, b'\x00' * self.block_size)
 
 
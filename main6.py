@@ -1,32 +1,199 @@
 import os
-from main import BlockSpace
+import threading
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+from batch import run_batch_file
+from block_cache import BlockCache
+from compress import CHUNK_SIZE, CODEC_NAMES, COMPRESSION_NONE, compress_chunk, decompress_chunk
+from dedup import DedupStore
+from defrag import Defragmenter, fragmentation_report
+from instrument import instrumented
+from locks import LockTable
+from main import (REPEATED, BlockSpace, append_extents, block_runs, extent_blocks, extent_length, replace_blocks,
+                  split_extents)
+from metadata import (DEDUP_INODE, INDEX_INODE, INODE_DIRECTORY, INODE_FILE, FileSystemMetadata,
+                      LazyDirectoryTable, LazyFileTable, read_superblock)
+from name_index import NameIndex, deserialize
+from scrub import BlockScrubber
 
 BLOCK_SIZES = [2 ** i for i in range(10, 17)]
+IMAGE_PATH = "block_space.bin"
+WAL_PATH = "block_space.wal"
+CACHE_BLOCKS = 256
+# Размер буфера потокового импорта и экспорта в блоках
+STREAM_CHUNK_BLOCKS = 64
+IO_WORKERS = 4
+# Ограничение скорости фоновой проверки контрольных сумм, МБ/с
+SCRUB_RATE_MB = 4
+# Дедупликация одинаковых блоков; образ с непустой таблицей дедупликации монтируется с ней всегда
+DEDUP = False
+# Окно упреждающего чтения при последовательном доступе, в блоках: растёт вдвое от минимума
+# до максимума (но не больше четверти кеша) и сбрасывается при случайном доступе
+READAHEAD_MIN_BLOCKS = 4
+READAHEAD_MAX_BLOCKS = 64
+# Ограничение скорости переноса блоков при дефрагментации, МБ/с
+DEFRAG_RATE_MB = 16
+# Сжатие данных новых файлов: None, "zlib" или "lzma"
+COMPRESSION = None
 
 class FileSystem:
-    def __init__(self, block_space, block_size):
+    def __init__(self, block_space, block_size, cache_blocks=0, metadata=None, io_workers=IO_WORKERS,
+                 dedup=False, compression=None, compress_workers=None):
         self.block_space = block_space
-        self.files = {}
-        self.directories = {"/": []}
+        # Операции чтения и записи данных идут через кеш блоков, если он включён
+        self.cache = BlockCache(block_space, cache_blocks) if cache_blocks else None
+        self.io = self.cache if self.cache is not None else block_space
+        # С метаданными на диске файлы и каталоги подгружаются по обращению.
+        # Каталог - словарь имя -> (инод, тип); у ещё не сохранённых записей инод None
+        self.metadata = metadata
+        if metadata is not None:
+            self.directories = LazyDirectoryTable(metadata)
+            self.files = LazyFileTable(metadata, self.directories)
+            # Индекс имён читается из служебного инода; у образов версии 1 строится обходом дерева
+            if metadata.has_name_index():
+                self.name_index = NameIndex(lambda: deserialize(metadata.read_system_file(INDEX_INODE)))
+            else:
+                self.name_index = NameIndex(self.walk_paths)
+        else:
+            self.files = {}
+            self.directories = {"/": {}}
+            self.name_index = NameIndex()
+        dedup_table = b''
+        if metadata is not None and metadata.has_dedup_table():
+            dedup_table = metadata.read_system_file(DEDUP_INODE)
+        self.dedup = None
+        if dedup or dedup_table:
+            self.dedup = DedupStore(block_space, self.io)
+            self.dedup.load(dedup_table)
         self.current_dir = "/"
         self.block_size = block_size  # Сохраняем размер блока
+        # Блокировки чтения/записи на каждый файл и каталог и пул потоков для ввода-вывода
+        self.locks = LockTable()
+        # Изменения пространства имён не пересекаются с сохранением метаданных (sync)
+        self.namespace_lock = metadata.lock if metadata is not None else threading.RLock()
+        self.io_workers = io_workers
+        self._io_pool = None
+        self._pool_guard = threading.Lock()
+        # Новые файлы сжимаются кусками по CHUNK_SIZE; при импорте - в пуле процессов
+        self.compression = CODEC_NAMES[compression] if compression else COMPRESSION_NONE
+        self.compress_workers = compress_workers
+        self._compress_pool = None
 
     def get_full_path(self, name):
         return os.path.join(self.current_dir, name)
 
-    def create_file(self, name):
+    def split_path(self, name):
         full_path = self.get_full_path(name)
-        if full_path in self.files or name in self.directories[self.current_dir]:
+        parent = os.path.dirname(full_path)
+        if parent not in self.directories:
+            raise Exception("Каталог не найден.")
+        return full_path, parent, os.path.basename(full_path)
+
+    def check_name_free(self, name):
+        full_path, parent, base_name = self.split_path(name)
+        if base_name in self.directories[parent]:
             raise Exception("Файл с таким именем уже существует или имя занято каталогом.")
+        return full_path
+
+    def register_file(self, name, extents, size=0, compression=COMPRESSION_NONE):
+        full_path, parent, base_name = self.split_path(name)
+        with self.locks.get(parent).write_locked(), self.namespace_lock:
+            try:
+                if base_name in self.directories[parent]:
+                    raise Exception("Файл с таким именем уже существует или имя занято каталогом.")
+                self.reserve_inode()
+            except Exception:
+                self.release_extents(extents)
+                raise
+            self.files[full_path] = {"size": size, "extents": extents, "position": 0, "block_size": self.block_size,
+                                     "compression": compression}
+            self.directories[parent][base_name] = (None, INODE_FILE)
+            self.name_index.add(full_path)
+            return self.files[full_path]
+
+    def reserve_inode(self):
+        # Иноды новым записям выделяются при sync, но их нехватка обнаруживается при создании
+        if self.metadata is not None:
+            self.metadata.reserve_inode()
+
+    def release_inode(self, entry):
+        # Удаление ещё не сохранённой записи возвращает её резерв инода
+        if self.metadata is not None and entry[0] is None:
+            self.metadata.unreserve_inode()
+
+    def release_extents(self, extents):
+        # С дедупликацией физический блок освобождается, когда на него не остаётся ссылок
+        extents = [extent for extent in extents if extent[1]]
+        if self.dedup is not None:
+            self.dedup.release_extents(extents)
+            return
+        if self.cache is not None:
+            self.cache.invalidate(list(extent_blocks(extents)))
+        self.block_space.release_extents(extents)
+
+    def write_blocks(self, file, first, data, blocks):
+        # Запись полных блоков файла начиная с логического блока first
+        if self.dedup is None:
+            self.io.write_data(data, blocks)
+            return
+        stored = self.dedup.write_blocks(data, blocks)
+        if stored != blocks:
+            file["extents"] = replace_blocks(file["extents"], first, stored)
+
+    def create(self, path, size=0):
+        self.check_name_free(path)
+        if self.compression:
+            # Куски сжатого файла выделяются при записи
+            return self.register_file(path, [], compression=self.compression)
+        num_blocks = (size + self.block_size - 1) // self.block_size
+        extents = self.block_space.allocate_extents(num_blocks) if num_blocks else []
+        if num_blocks and not extents:
+            raise Exception("Недостаточно свободных блоков.")
+        return self.register_file(path, extents)
+
+    def io_pool(self):
+        with self._pool_guard:
+            if self._io_pool is None:
+                self._io_pool = ThreadPoolExecutor(max_workers=self.io_workers, thread_name_prefix="fs-io")
+            return self._io_pool
+
+    def submit_read(self, path, offset, length):
+        return self.io_pool().submit(self.read, path, offset, length)
+
+    def submit_write(self, path, offset, data):
+        return self.io_pool().submit(self.write, path, offset, data)
+
+    def read_many(self, requests):
+        # Чтения разных файлов выполняются параллельно в пуле потоков
+        futures = [self.submit_read(*request) for request in requests]
+        return [future.result() for future in futures]
+
+    def compress_pool(self):
+        with self._pool_guard:
+            if self._compress_pool is None:
+                self._compress_pool = ProcessPoolExecutor(max_workers=self.compress_workers)
+            return self._compress_pool
+
+    def close(self):
+        with self._pool_guard:
+            if self._io_pool is not None:
+                self._io_pool.shutdown(wait=True)
+                self._io_pool = None
+            if self._compress_pool is not None:
+                self._compress_pool.shutdown(wait=True)
+                self._compress_pool = None
+
+    def create_file(self, name):
+        self.check_name_free(name)
 
         num_blocks = int(input("Введите количество блоков для файла: "))
 
-        blocks = self.block_space.allocate_blocks(num_blocks)
-        if not blocks:
+        extents = self.block_space.allocate_extents(num_blocks)
+        if not extents:
             raise Exception("Недостаточно свободных блоков.")
 
-        self.files[full_path] = {"size": 0, "blocks": blocks, "position": 0, "block_size": self.block_size}
-        self.directories[self.current_dir].append(name)
+        self.register_file(name, extents)
         print(f"Файл {name} создан с {num_blocks} блоками по {self.block_size} байт.")
 
     def open_file(self, name):
@@ -35,62 +202,291 @@ class FileSystem:
             raise Exception("Файл не найден.")
         return self.files[full_path]
 
+    def file_blocks(self, file, first=0, count=None):
+        # Физические блоки логических блоков first..first+count-1 (по умолчанию - до конца файла);
+        # разворачивается только нужный диапазон экстентов
+        if file.get("compression"):
+            raise Exception("Поблочный доступ к сжатому файлу невозможен.")
+        extents = file["extents"]
+        if first:
+            extents = split_extents(extents, first)[1]
+        if count is not None:
+            extents = split_extents(extents, count)[0]
+        return list(extent_blocks(extents))
+
+    def block_count(self, file):
+        return sum(extent_length(count) for _, count in file["extents"])
+
+    def ensure_blocks(self, file, blocks_needed):
+        # Недостающие блоки дописываются новыми экстентами в конец файла
+        present = self.block_count(file)
+        if present < blocks_needed:
+            new_extents = self.block_space.allocate_extents(blocks_needed - present)
+            if not new_extents:
+                raise Exception("Недостаточно свободных блоков для записи.")
+            append_extents(file["extents"], new_extents)
+
+    @property
+    def instrumentation(self):
+        # Статистика операций FileSystem собирается вместе со статистикой BlockSpace
+        return self.block_space.instrumentation
+
+    @instrumented('fs_read', lambda self, path, offset, length: length)
+    def read(self, path, offset, length):
+        with self.locks.get(self.get_full_path(path)).read_locked():
+            return self._read(path, offset, length)
+
+    def read_plan(self, path, offset, length):
+        # Блоки, покрывающие байтовый диапазон, смещение данных в первом блоке и длина
+        file = self.open_file(path)
+        if offset < 0 or length < 0:
+            raise Exception("Недопустимое смещение или длина.")
+        end = min(offset + length, file["size"])
+        if offset >= end:
+            return [], 0, 0
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        # Чтение с того места, где закончилось предыдущее, считается последовательным
+        sequential = offset == file["position"]
+        file["position"] = end
+        blocks = self.file_blocks(file, first, last - first + 1)
+        self.read_ahead(file, last, sequential)
+        return blocks, offset - first * self.block_size, end - offset
+
+    def read_ahead(self, file, last, sequential):
+        # Фоновая подгрузка в кеш блоков, следующих за прочитанным, при последовательном доступе
+        if self.cache is None:
+            return
+        if not sequential:
+            file["readahead"] = 0
+            file["readahead_end"] = 0
+            return
+        limit = min(READAHEAD_MAX_BLOCKS, max(1, self.cache.capacity // 4))
+        window = min(limit, max(READAHEAD_MIN_BLOCKS, file.get("readahead", 0) * 2))
+        file["readahead"] = window
+        start = max(last + 1, file.get("readahead_end", 0))
+        end = min(self.block_count(file), last + 1 + window)
+        if start < end:
+            file["readahead_end"] = end
+            # Поколение берётся сейчас: задача может ждать в пуле, пока блоки файла освобождаются
+            self.io_pool().submit(self.cache.prefetch, self.file_blocks(file, start, end - start),
+                                  self.cache.generation())
+
+    def _read(self, path, offset, length):
+        # Чтение по байтовому смещению: нужные блоки вычисляются по экстентам файла
+        file = self.open_file(path)
+        if file.get("compression"):
+            return self._read_compressed(file, offset, length)
+        blocks, start, size = self.read_plan(path, offset, length)
+        if not blocks:
+            return b''
+        buffer = bytearray(len(blocks) * self.block_size)
+        self.io.read_data(blocks, buffer)
+        return bytes(buffer[start:start + size])
+
+    @instrumented('fs_write', lambda self, path, offset, data: len(data))
+    def write(self, path, offset, data):
+        with self.locks.get(self.get_full_path(path)).write_locked():
+            return self._write(path, offset, data)
+
+    def _write(self, path, offset, data):
+        file = self.open_file(path)
+        if offset < 0:
+            raise Exception("Недопустимое смещение.")
+        if not data:
+            return 0
+        if file.get("compression"):
+            return self._write_compressed(file, offset, data)
+        end = offset + len(data)
+        self.ensure_blocks(file, (end + self.block_size - 1) // self.block_size)
+        first = offset // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = self.file_blocks(file, first, last - first + 1)
+        head = offset - first * self.block_size
+        if head == 0 and end % self.block_size == 0:
+            buffer = memoryview(data)
+        else:
+            # Неполные крайние блоки дочитываются, чтобы не затереть соседние данные
+            buffer = bytearray(len(blocks) * self.block_size)
+            if head:
+                self.io.read_data(blocks[:1], memoryview(buffer)[:self.block_size])
+            if end % self.block_size and (len(blocks) > 1 or not head):
+                self.io.read_data(blocks[-1:], memoryview(buffer)[-self.block_size:])
+            buffer[head:head + len(data)] = data
+        self.write_blocks(file, first, buffer, blocks)
+        file["size"] = max(file["size"], end)
+        file["position"] = end
+        return len(data)
+
+    def _read_chunk(self, file, index):
+        # Исходные данные куска сжатого файла; у незаписанного куска - пустые
+        extents = file["extents"]
+        if index >= len(extents) or not extents[index][1]:
+            return b''
+        start, count = extents[index]
+        stored = bytearray(count * self.block_size)
+        self.io.read_data(list(range(start, start + count)), stored)
+        return decompress_chunk(stored, file["compression"])
+
+    def _store_chunk(self, file, index, stored):
+        # Сжатый кусок занимает один непрерывный экстент; при смене размера
+        # выделяется новый, а старый освобождается
+        extents = file["extents"]
+        while len(extents) <= index:
+            extents.append((0, 0))
+        count = (len(stored) + self.block_size - 1) // self.block_size
+        old = extents[index]
+        start = old[0]
+        if old[1] != count:
+            blocks = self.block_space.allocate_blocks(count)
+            if not blocks:
+                raise Exception("Недостаточно свободных блоков для сжатого файла.")
+            start = blocks[0]
+        self.io.write_data(stored + bytes(count * self.block_size - len(stored)), list(range(start, start + count)))
+        if old[1] != count:
+            extents[index] = (start, count)
+            self.release_extents([old])
+
+    def _read_compressed(self, file, offset, length):
+        # Распаковываются только куски, которые задевает диапазон
+        if offset < 0 or length < 0:
+            raise Exception("Недопустимое смещение или длина.")
+        end = min(offset + length, file["size"])
+        if offset >= end:
+            return b''
+        result = bytearray(end - offset)
+        for index in range(offset // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1):
+            chunk = self._read_chunk(file, index)
+            base = index * CHUNK_SIZE
+            low = max(offset, base)
+            high = min(end, base + len(chunk))
+            if low < high:
+                result[low - offset:high - offset] = chunk[low - base:high - base]
+        file["position"] = end
+        return bytes(result)
+
+    def _write_compressed(self, file, offset, data):
+        end = offset + len(data)
+        for index in range(offset // CHUNK_SIZE, (end - 1) // CHUNK_SIZE + 1):
+            base = index * CHUNK_SIZE
+            low = max(offset, base)
+            high = min(end, base + CHUNK_SIZE)
+            if low == base and high == base + CHUNK_SIZE:
+                chunk = data[low - offset:high - offset]
+            else:
+                chunk = bytearray(self._read_chunk(file, index))
+                if len(chunk) < high - base:
+                    chunk.extend(bytes(high - base - len(chunk)))
+                chunk[low - base:high - base] = data[low - offset:high - offset]
+            self._store_chunk(file, index, compress_chunk(chunk, file["compression"]))
+        file["size"] = max(file["size"], end)
+        file["position"] = end
+        return len(data)
+
     def write_file(self, name, data):
         file = self.open_file(name)
         blocks_needed = (len(data) + file["block_size"] - 1) // file["block_size"]
+        self.ensure_blocks(file, blocks_needed)
+        blocks = self.file_blocks(file)
 
-        while len(file["blocks"]) < blocks_needed:
-            new_blocks = self.block_space.allocate_blocks(1)
-            if not new_blocks:
-                raise Exception("Недостаточно свободных блоков для записи.")
-            file["blocks"].extend(new_blocks)
-
-        block_index = int(input(f"Введите номер блока (0 до {len(file['blocks']) - 1}) для записи данных: "))
-        if block_index < 0 or block_index >= len(file["blocks"]):
+        block_index = int(input(f"Введите номер блока (0 до {len(blocks) - 1}) для записи данных: "))
+        if block_index < 0 or block_index >= len(blocks):
             raise Exception("Недопустимый номер блока.")
 
-        self.block_space.write_data(data, [file["blocks"][block_index]])
+        block = data
+        if self.dedup is not None:
+            # Блок может быть общим, поэтому пишется целиком поверх текущего содержимого
+            block = bytearray(self.block_size)
+            self.io.read_data([blocks[block_index]], block)
+            block[:len(data[:self.block_size])] = data[:self.block_size]
+        self.write_blocks(file, block_index, block, [blocks[block_index]])
         file["size"] = len(data)
         file["position"] = len(data)
-        print(f"Данные записаны в блок {block_index} файла {name}.")
+        # При дедупликации блок мог переехать на общий, поэтому номер берётся после записи
+        physical = self.file_blocks(file, block_index, 1)[0]
+        print(f"Данные записаны в блок {block_index} файла {name} (физический блок {physical}).")
 
     def read_file(self, name):
         file = self.open_file(name)
+        blocks = self.file_blocks(file)
 
-        block_index = int(input(f"Введите номер блока (0 до {len(file['blocks']) - 1}) для чтения данных: "))
-        if block_index < 0 or block_index >= len(file["blocks"]):
+        block_index = int(input(f"Введите номер блока (0 до {len(blocks) - 1}) для чтения данных: "))
+        if block_index < 0 or block_index >= len(blocks):
             raise Exception("Недопустимый номер блока.")
 
         buffer = bytearray(file["block_size"])
-        self.block_space.read_data([file["blocks"][block_index]], buffer)
-        print(f"Данные из блока {block_index} файла {name}: {buffer.decode('utf-8', errors='ignore')}")
+        self.io.read_data([blocks[block_index]], buffer)
+        print(f"Данные из блока {block_index} файла {name} (физический блок {blocks[block_index]}): "
+              f"{buffer.decode('utf-8', errors='ignore')}")
 
     def delete_file(self, name):
         full_path = self.get_full_path(name)
         if full_path not in self.files:
             raise Exception("Файл не найден.")
+        full_path, parent, base_name = self.split_path(name)
 
-        file = self.files.pop(full_path)
-        self.block_space.release_blocks(file["blocks"])
-        self.directories[self.current_dir].remove(name)
+        with self.locks.get(parent).write_locked(), self.locks.get(full_path).write_locked(), self.namespace_lock:
+            file = self.files.pop(full_path)
+            self.release_extents(file["extents"])
+            self.release_inode(self.directories[parent].pop(base_name))
+            self.name_index.remove(full_path)
         print(f"Файл {name} удалён.")
 
+    def flush(self):
+        if self.cache is not None:
+            self.cache.flush()
+
+    def sync(self):
+        # Сохранение метаданных на диск одной транзакцией
+        self.flush()
+        if self.metadata is None:
+            return
+        started = not self.block_space.transaction_active
+        if started:
+            self.block_space.start_transaction()
+        try:
+            self.metadata.sync(self.files, self.directories, self.name_index, self.dedup)
+        except Exception:
+            # Иначе все последующие записи потока остались бы в незавершённой транзакции
+            if started:
+                self.block_space.rollback_transaction()
+            raise
+        if started:
+            self.block_space.commit_transaction()
+        self.block_space.flush_commits()
+
+    def cache_stats(self):
+        if self.cache is None:
+            return None
+        stats = self.cache.stats()
+        stats['readahead_windows'] = {path: file["readahead"] for path, file in list(dict.items(self.files))
+                                      if file.get("readahead")}
+        return stats
+
     def create_directory(self, name):
-        path = self.get_full_path(name)
-        if path in self.directories:
-            raise Exception("Каталог уже существует.")
-        self.directories[path] = []
-        self.directories[self.current_dir].append(name)
+        path, parent, base_name = self.split_path(name)
+        with self.locks.get(parent).write_locked(), self.namespace_lock:
+            if path in self.directories:
+                raise Exception("Каталог уже существует.")
+            if base_name in self.directories[parent]:
+                raise Exception("Имя занято файлом.")
+            self.reserve_inode()
+            self.directories[path] = {}
+            self.directories[parent][base_name] = (None, INODE_DIRECTORY)
+            self.name_index.add(path)
         print(f"Каталог {name} создан.")
 
     def delete_directory(self, name):
         path = self.get_full_path(name)
         if path not in self.directories:
             raise Exception("Каталог не найден.")
-        if self.directories[path]:
-            raise Exception("Каталог не пуст.")
-        del self.directories[path]
-        self.directories[self.current_dir].remove(name)
+        path, parent, base_name = self.split_path(name)
+        with self.locks.get(parent).write_locked(), self.locks.get(path).write_locked(), self.namespace_lock:
+            if self.directories[path]:
+                raise Exception("Каталог не пуст.")
+            del self.directories[path]
+            self.release_inode(self.directories[parent].pop(base_name))
+            self.name_index.remove(path)
         print(f"Каталог {name} удалён.")
 
     def change_directory(self, name):
@@ -107,48 +503,168 @@ class FileSystem:
 
     def list_directory(self):
         items = []
-        for name in self.directories[self.current_dir]:
-            full_path = self.get_full_path(name)
-            if full_path in self.files:
-                items.append(f"{name} (файл)")
-            else:
-                items.append(f"{name} (каталог)")
+        with self.locks.get(self.current_dir).read_locked():
+            for name, (_, entry_type) in self.directories[self.current_dir].items():
+                if entry_type == INODE_FILE:
+                    items.append(f"{name} (файл)")
+                else:
+                    items.append(f"{name} (каталог)")
         return items
 
     def import_file(self, src_path, dest_name):
+        # Потоковый импорт: все экстенты выделяются одним вызовом, данные копируются
+        # кусками по STREAM_CHUNK_BLOCKS блоков через один и тот же буфер
         if not os.path.exists(src_path):
             raise Exception("Исходный файл не найден.")
-        with open(src_path, 'rb') as f:
-            data = f.read()
-        self.create_file(dest_name)
-        self.write_file(dest_name, data)
+        self.check_name_free(dest_name)
+
+        size = os.path.getsize(src_path)
+        if self.compression:
+            self.import_compressed(src_path, dest_name, size)
+            print(f"Файл {src_path} импортирован как {dest_name}.")
+            return
+        num_blocks = (size + self.block_size - 1) // self.block_size
+        extents = self.block_space.allocate_extents(num_blocks) if num_blocks else []
+        if num_blocks and not extents:
+            raise Exception("Недостаточно свободных блоков.")
+
+        buffer = memoryview(bytearray(STREAM_CHUNK_BLOCKS * self.block_size))
+        # Записанные блоки файла; при дедупликации часть из них заменяется общими
+        stored = []
+        try:
+            with open(src_path, 'rb') as f:
+                for start, count in extents:
+                    while count > 0:
+                        step = min(count, STREAM_CHUNK_BLOCKS)
+                        chunk = buffer[:step * self.block_size]
+                        read = f.readinto(chunk)
+                        if read < len(chunk):
+                            chunk[read:] = bytes(len(chunk) - read)
+                        if self.dedup is None:
+                            self.block_space.write_range(start, chunk)
+                            stored.extend(range(start, start + step))
+                        else:
+                            stored.extend(self.dedup.write_blocks(chunk, list(range(start, start + step))))
+                        start += step
+                        count -= step
+        except Exception:
+            self.release_extents(block_runs(stored + list(extent_blocks(extents))[len(stored):]))
+            raise
+        if self.dedup is None and self.cache is not None:
+            # Данные записаны мимо кеша: в нём не должно остаться прежнего содержимого этих блоков
+            self.cache.invalidate(stored)
+
+        self.register_file(dest_name, block_runs(stored), size)
         print(f"Файл {src_path} импортирован как {dest_name}.")
 
-    def search_files(self, substring, current_dir="/"):
-        found_files = []
-        # Проверяем текущий каталог
-        for name in self.directories[current_dir]:
+    def import_compressed(self, src_path, dest_name, size):
+        # Куски сжимаются в пуле процессов и записываются по порядку по мере готовности;
+        # в работе одновременно не больше двух кусков на процесс
+        file = {"extents": [], "compression": self.compression}
+        pool = self.compress_pool() if size > CHUNK_SIZE else None
+        window = 2 * (self.compress_workers or os.cpu_count() or 1)
+        pending = deque()
+        try:
+            with open(src_path, 'rb') as f:
+                for data in iter(lambda: f.read(CHUNK_SIZE), b''):
+                    if pool is None:
+                        self._store_chunk(file, len(file["extents"]), compress_chunk(data, self.compression))
+                        continue
+                    pending.append(pool.submit(compress_chunk, data, self.compression))
+                    if len(pending) >= window:
+                        self._store_chunk(file, len(file["extents"]), pending.popleft().result())
+                while pending:
+                    self._store_chunk(file, len(file["extents"]), pending.popleft().result())
+        except Exception:
+            for future in pending:
+                future.cancel()
+            self.release_extents(file["extents"])
+            raise
+        self.register_file(dest_name, file["extents"], size, self.compression)
+
+    def export_file(self, name, dest_path):
+        file = self.open_file(name)
+        self.flush()
+        remaining = file["size"]
+        if file.get("compression"):
+            with self.locks.get(self.get_full_path(name)).read_locked(), open(dest_path, 'wb') as f:
+                for index in range((remaining + CHUNK_SIZE - 1) // CHUNK_SIZE):
+                    length = min(CHUNK_SIZE, remaining - index * CHUNK_SIZE)
+                    chunk = self._read_chunk(file, index)[:length]
+                    f.write(chunk + bytes(length - len(chunk)))
+            print(f"Файл {name} экспортирован в {dest_path}.")
+            return
+        buffer = memoryview(bytearray(STREAM_CHUNK_BLOCKS * self.block_size))
+        with self.locks.get(self.get_full_path(name)).read_locked(), open(dest_path, 'wb') as f:
+            for start, count in file["extents"]:
+                repeated = count & REPEATED
+                count &= ~REPEATED
+                if repeated:
+                    # Повторённый блок читается один раз и размножается в буфере
+                    self.block_space.read_range(start, 1, buffer[:self.block_size])
+                    buffer[self.block_size:] = bytes(buffer[:self.block_size]) * (STREAM_CHUNK_BLOCKS - 1)
+                while count > 0 and remaining > 0:
+                    step = min(count, STREAM_CHUNK_BLOCKS)
+                    chunk = buffer[:step * self.block_size]
+                    if not repeated:
+                        self.block_space.read_range(start, step, chunk)
+                        start += step
+                    f.write(chunk[:min(len(chunk), remaining)])
+                    remaining -= len(chunk)
+                    count -= step
+        print(f"Файл {name} экспортирован в {dest_path}.")
+
+    def walk_paths(self, current_dir="/"):
+        # Полный обход дерева; нужен только для построения индекса имён
+        for name, (_, entry_type) in list(self.directories[current_dir].items()):
             full_path = os.path.join(current_dir, name)
-            if substring in name:
-                found_files.append((name, current_dir))  # Добавляем имя файла и каталог
-            # Рекурсивно ищем в подкаталогах
-            if full_path in self.directories:
-                found_files.extend(self.search_files(substring, full_path))
-        return found_files
+            yield full_path
+            if entry_type == INODE_DIRECTORY:
+                yield from self.walk_paths(full_path)
 
-def main():
-    with open("block_space.bin", 'wb') as f:
-        f.write(b'')
-
-    total_blocks = int(input("Введите общее количество блоков для файлов: "))
-    block_size = int(input("Введите размер блока (в байтах): "))
-
-    if block_size not in BLOCK_SIZES:
-        raise Exception("Недопустимый размер блока. Выберите размер из допустимых значений.")
-
-    block_space = BlockSpace("block_space.bin", block_size, total_blocks)
-    fs = FileSystem(block_space, block_size)
+    @instrumented('search_files')
+    def search_files(self, substring, current_dir="/"):
+        # Поиск по индексу имён без обхода каталогов: (имя, каталог) для путей внутри current_dir
+        prefix = current_dir.rstrip("/") + "/"
+        return [(os.path.basename(path), os.path.dirname(path))
+                for path in self.name_index.search(substring) if path.startswith(prefix)]
 
+def main():
+    superblock = read_superblock(IMAGE_PATH)
+    if superblock is None:
+        for path in (IMAGE_PATH, WAL_PATH):
+            with open(path, 'wb') as f:
+                f.write(b'')
+
+        total_blocks = int(input("Введите общее количество блоков для файлов: "))
+        block_size = int(input("Введите размер блока (в байтах): "))
+
+        if block_size not in BLOCK_SIZES:
+            raise Exception("Недопустимый размер блока. Выберите размер из допустимых значений.")
+    else:
+        total_blocks = superblock["total_blocks"]
+        block_size = superblock["block_size"]
+
+    with BlockSpace(IMAGE_PATH, block_size, total_blocks, wal_filename=WAL_PATH) as block_space:
+        if superblock is None:
+            metadata = FileSystemMetadata.format(block_space)
+            print(f"Образ {IMAGE_PATH} отформатирован.")
+        else:
+            metadata = FileSystemMetadata.mount(block_space)
+            print(f"Образ {IMAGE_PATH} смонтирован: {total_blocks} блоков по {block_size} байт.")
+        fs = FileSystem(block_space, block_size, CACHE_BLOCKS, metadata, dedup=DEDUP, compression=COMPRESSION)
+        scrubber = BlockScrubber(block_space, SCRUB_RATE_MB, fs.cache)
+        scrubber.start()
+        try:
+            run(fs)
+        finally:
+            scrubber.stop()
+        if scrubber.damaged_blocks:
+            print(f"Обнаружены повреждённые блоки: {sorted(scrubber.damaged_blocks)}")
+        fs.sync()
+        fs.close()
+
+def run(fs):
     while True:
         print(f"\nТекущий каталог: {fs.current_dir}")
         print("Выберите действие:")
@@ -162,7 +678,10 @@ def main():
         print("8 - Список содержимого каталога")
         print("9 - Импортировать файл")
         print("10 - Найти файл")
-        print("11 - Выход")
+        print("11 - Экспортировать файл")
+        print("12 - Выполнить пакет команд")
+        print("13 - Дефрагментация и сжатие образа")
+        print("14 - Выход")
 
         choice = input("Введите номер действия: ")
 
@@ -215,6 +734,28 @@ def main():
                     print("Файлы не найдены.")
 
             elif choice == '11':
+                name = input("Введите имя файла: ")
+                dest_path = input("Введите путь для сохранения: ")
+                fs.export_file(name, dest_path)
+
+            elif choice == '12':
+                script_path = input("Введите путь к файлу команд: ")
+                report = run_batch_file(fs, script_path)
+                for result in report["results"]:
+                    if "error" in result:
+                        print(f"Ошибка в операции {result['op']}: {result['error']}")
+                print(f"Выполнено операций: {report['operations']} "
+                      f"({report['executed']} после объединения), ошибок: {report['errors']}, "
+                      f"{report['ops_per_sec']:.1f} оп/с.")
+
+            elif choice == '13':
+                print("Фрагментация до:", fragmentation_report(fs))
+                defragmenter = Defragmenter(fs, DEFRAG_RATE_MB)
+                defragmenter.run_pass()
+                print("Фрагментация после:", defragmenter.compact())
+                print(f"Перенесено файлов: {defragmenter.moved_files}, блоков: {defragmenter.moved_blocks}.")
+
+            elif choice == '14':
                 print("Выход из программы.")
                 break
 
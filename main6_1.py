@@ -1,23 +1,98 @@
+import posixpath
+
+from name_index import NameIndex
+
+PAGE_SIZE = 4096
+
+class ChunkedContent:
+    # Содержимое файла страницами по page_size байт. Незаписанные страницы - дыры и читаются
+    # нулями; страницы, взятые из импортированного буфера, копируются при первой записи
+    def __init__(self, page_size=PAGE_SIZE):
+        self.page_size = page_size
+        self.pages = {}
+        self.size = 0
+
+    @classmethod
+    def from_buffer(cls, data, page_size=PAGE_SIZE):
+        content = cls(page_size)
+        view = memoryview(data).cast("B")
+        for index, start in enumerate(range(0, len(view), page_size)):
+            content.pages[index] = view[start:start + page_size]
+        content.size = len(view)
+        return content
+
+    def __len__(self):
+        return self.size
+
+    def __bytes__(self):
+        return bytes(self.read(0, self.size))
+
+    def read(self, start, end):
+        # Диапазон внутри одной страницы возвращается представлением без копирования
+        end = min(end, self.size)
+        if start >= end:
+            return memoryview(b"")
+        first, offset = divmod(start, self.page_size)
+        last = (end - 1) // self.page_size
+        page = self.pages.get(first)
+        if first == last and page is not None and offset + end - start <= len(page):
+            return memoryview(page)[offset:offset + end - start]
+        result = bytearray(end - start)
+        for index in range(first, last + 1):
+            page = self.pages.get(index)
+            if page is None:
+                continue
+            page_start = index * self.page_size
+            low = max(start, page_start)
+            high = min(end, page_start + len(page))
+            if low < high:
+                result[low - start:high - start] = page[low - page_start:high - page_start]
+        return memoryview(result)
+
+    def write(self, offset, data):
+        data = memoryview(data).cast("B")
+        position = 0
+        while position < len(data):
+            index, page_offset = divmod(offset + position, self.page_size)
+            step = min(self.page_size - page_offset, len(data) - position)
+            self._own_page(index)[page_offset:page_offset + step] = data[position:position + step]
+            position += step
+        if position:
+            self.size = max(self.size, offset + position)
+
+    def _own_page(self, index):
+        page = self.pages.get(index)
+        if not isinstance(page, bytearray):
+            owned = bytearray(self.page_size)
+            if page is not None:
+                owned[:len(page)] = page
+            page = self.pages[index] = owned
+        return page
+
 class VirtualFile:
     def __init__(self, name):
         if len(name) > 256:
             raise ValueError("File name exceeds the limit of 256 characters.")
         self.name = name
-        self.content = bytearray()
+        self.content = ChunkedContent()
         self.position = 0
 
 class VirtualFileSystem:
     def __init__(self):
         self.files = {}
-        self.directories = {"/": []}
+        # Каталог - словарь имя -> объект: VirtualFile для файлов, словарь для подкаталогов
+        self.directories = {"/": {}}
+        self.name_index = NameIndex()
         self.current_directory = "/"
 
     def create_file(self, file_path):
         path, name = self._split_path(file_path)
-        if name in self.directories.get(path, []):
+        if name in self.directories.get(path, {}):
             raise FileExistsError("File already exists.")
-        self.files[file_path] = VirtualFile(name)
-        self.directories[path].append(name)
+        file_obj = VirtualFile(name)
+        self.directories[path][name] = file_obj
+        self.files[file_path] = file_obj
+        self.name_index.add(posixpath.join(path, name))
 
     def open_file(self, file_path):
         if file_path not in self.files:
@@ -33,29 +108,26 @@ class VirtualFileSystem:
         start = file_obj.position
         end = min(file_obj.position + length, len(file_obj.content))
         file_obj.position = end
-        return file_obj.content[start:end]
+        return file_obj.content.read(start, end)
 
     def write_file(self, file_obj, data):
-        start = file_obj.position
-        end = start + len(data)
-        if end > len(file_obj.content):
-            file_obj.content.extend(b"\x00" * (end - len(file_obj.content)))
-        file_obj.content[start:end] = data
-        file_obj.position = end
+        file_obj.content.write(file_obj.position, data)
+        file_obj.position += len(memoryview(data).cast("B"))
 
     def delete_file(self, file_path):
         path, name = self._split_path(file_path)
         if file_path in self.files:
             del self.files[file_path]
-            self.directories[path].remove(name)
+            del self.directories[path][name]
+            self.name_index.remove(posixpath.join(path, name))
         else:
             raise FileNotFoundError("File not found.")
 
     def find_files(self, directory, mask="*.*"):
-        import fnmatch
         if directory not in self.directories:
             raise FileNotFoundError("Directory not found.")
-        return [f for f in self.directories[directory] if fnmatch.fnmatch(f, mask)]
+        paths = self.name_index.match(mask, directory, names=self.directories[directory])
+        return [posixpath.basename(path) for path in paths]
 
     def create_directory(self, directory):
         path, name = self._split_path(directory)
@@ -63,8 +135,9 @@ class VirtualFileSystem:
             raise FileExistsError("Directory already exists.")
         if path not in self.directories:
             raise FileNotFoundError("Parent directory not found.")
-        self.directories[directory] = []
-        self.directories[path].append(name)
+        self.directories[directory] = {}
+        self.directories[path][name] = self.directories[directory]
+        self.name_index.add(posixpath.join(path, name))
 
     def delete_directory(self, directory):
         if directory not in self.directories:
@@ -73,7 +146,8 @@ class VirtualFileSystem:
             raise OSError("Directory is not empty.")
         del self.directories[directory]
         path, name = self._split_path(directory)
-        self.directories[path].remove(name)
+        del self.directories[path][name]
+        self.name_index.remove(posixpath.join(path, name))
 
     def change_directory(self, directory):
         if directory not in self.directories:
@@ -90,7 +164,7 @@ class VirtualFileSystem:
         if target_path not in self.files:
             self.create_file(target_path)
         file_obj = self.files[target_path]
-        file_obj.content = bytearray(data)
+        file_obj.content = ChunkedContent.from_buffer(data)
 
     def _split_path(self, path):
         if "/" not in path:
@@ -104,4 +178,4 @@ vfs.create_directory("/documents")
 vfs.create_file("/documents/file1.txt")
 file = vfs.open_file("/documents/file1.txt")
 vfs.write_file(file, b"Hello, World!")
-print(vfs.read_file(file, 100))
+print(bytes(vfs.read_file(file, 100)))
@@ -0,0 +1,542 @@
+import os
+import struct
+import threading
+
+from main import extent_blocks
+
+# Формат образа:
+#   блок 0 - суперблок;
+#   битовая карта блоков, битовая карта инодов, таблица инодов фиксированного размера;
+#   с версии 3 - таблица CRC32 всех блоков;
+#   далее - блоки данных. Содержимое каталога хранится как данные его инода.
+# С версии 2 инод 1 - служебный файл с индексом имён, с версии 4 инод 2 - таблица дедупликации.
+# Байт флагов инода файла - алгоритм сжатия (compress.COMPRESSION_*); экстенты сжатого файла -
+# его куски по порядку, экстент (0, 0) - незаписанный кусок. Старший бит числа блоков
+# экстента (main.REPEATED) - один блок, повторённый несколько раз (дедупликация).
+# Экстенты сверх помещающихся в инод лежат в косвенных блоках; если они не помещаются
+# в один блок, последняя запись блока - (номер следующего косвенного блока, 0).
+
+MAGIC = b'OS6FS\x00\x00\x01'
+VERSION = 4
+SUPERBLOCK = struct.Struct('<8sIIQIIIIIIIIII')
+INODE_HEADER = struct.Struct('<BBHIQ')
+EXTENT = struct.Struct('<II')
+DIRECTORY_ENTRY = struct.Struct('<IBH')
+INODE_SIZE = 128
+INLINE_EXTENTS = (INODE_SIZE - INODE_HEADER.size) // EXTENT.size
+
+INODE_FREE = 0
+INODE_FILE = 1
+INODE_DIRECTORY = 2
+INODE_SYSTEM = 3
+ROOT_INODE = 0
+INDEX_INODE = 1
+DEDUP_INODE = 2
+
+SUPERBLOCK_FIELDS = ("magic", "version", "block_size", "total_blocks",
+                     "bitmap_start", "bitmap_blocks", "inode_bitmap_start", "inode_bitmap_blocks",
+                     "inode_table_start", "inode_table_blocks", "inode_count", "root_inode",
+                     "checksum_start", "checksum_blocks")
+
+def parse_superblock(data):
+    if len(data) < SUPERBLOCK.size:
+        return None
+    fields = SUPERBLOCK.unpack_from(data)
+    if fields[0] != MAGIC:
+        return None
+    return dict(zip(SUPERBLOCK_FIELDS, fields))
+
+def read_superblock(filename):
+    # Параметры образа или None, если файл не отформатирован
+    if not os.path.exists(filename):
+        return None
+    with open(filename, 'rb') as f:
+        return parse_superblock(f.read(SUPERBLOCK.size))
+
+def blocks_for(size, block_size):
+    return (size + block_size - 1) // block_size
+
+class FileSystemMetadata:
+    def __init__(self, block_space, superblock):
+        self.block_space = block_space
+        self.block_size = block_space.block_size
+        self.superblock = superblock
+        self.inode_count = superblock["inode_count"]
+        self.inode_bitmap = bytearray((self.inode_count + 7) // 8)
+        self.used_inodes = 0
+        # Иноды новым записям каталогов выделяются при sync, но резервируются при создании записи
+        self.reserved_inodes = 0
+        # Записей экстентов в одном косвенном блоке
+        self.indirect_extents = self.block_size // EXTENT.size
+        # Сохранённые на диске записи загруженных каталогов: путь -> {имя: (инод, тип)},
+        # и путь -> инод каталога
+        self.entries = {}
+        self.dir_inodes = {"/": ROOT_INODE}
+        # Последняя сохранённая таблица контрольных сумм: перезаписываются только изменённые блоки
+        self.saved_checksums = None
+        # Блоки, выделенные текущим сохранением: освобождаются, если оно не удалось
+        self.allocated = []
+        self.lock = threading.RLock()
+
+    @classmethod
+    def format(cls, block_space, inode_count=None):
+        block_size = block_space.block_size
+        total_blocks = block_space.total_blocks
+        if inode_count is None:
+            inode_count = max(16, total_blocks // 8)
+        bitmap_blocks = blocks_for((total_blocks + 7) // 8, block_size)
+        inode_bitmap_blocks = blocks_for((inode_count + 7) // 8, block_size)
+        inode_table_blocks = blocks_for(inode_count * INODE_SIZE, block_size)
+        checksum_start = 1 + bitmap_blocks + inode_bitmap_blocks + inode_table_blocks
+        checksum_blocks = blocks_for(total_blocks * 4, block_size) if block_space.checksums is not None else 0
+        reserved = checksum_start + checksum_blocks
+        if reserved >= total_blocks:
+            raise Exception("Слишком мало блоков для служебных областей образа.")
+
+        superblock = dict(magic=MAGIC, version=VERSION, block_size=block_size, total_blocks=total_blocks,
+                          bitmap_start=1, bitmap_blocks=bitmap_blocks,
+                          inode_bitmap_start=1 + bitmap_blocks, inode_bitmap_blocks=inode_bitmap_blocks,
+                          inode_table_start=1 + bitmap_blocks + inode_bitmap_blocks,
+                          inode_table_blocks=inode_table_blocks,
+                          inode_count=inode_count, root_inode=ROOT_INODE,
+                          checksum_start=checksum_start, checksum_blocks=checksum_blocks)
+        block_space.reserve_range(0, reserved)
+        block_space.clear_range(0, reserved)
+        block_space.write_range(0, SUPERBLOCK.pack(*(superblock[field] for field in SUPERBLOCK_FIELDS)))
+
+        metadata = cls(block_space, superblock)
+        metadata._set_inode_bit(ROOT_INODE, True)
+        metadata._set_inode_bit(INDEX_INODE, True)
+        metadata._set_inode_bit(DEDUP_INODE, True)
+        metadata.entries["/"] = {}
+        metadata._write_inodes({ROOT_INODE: (INODE_DIRECTORY, 0, []), INDEX_INODE: (INODE_SYSTEM, 0, []),
+                                DEDUP_INODE: (INODE_SYSTEM, 0, [])})
+        metadata._write_bitmaps()
+        metadata._write_checksums()
+        block_space.sync()
+        return metadata
+
+    @classmethod
+    def mount(cls, block_space):
+        # Читаются только суперблок и битовые карты, иноды загружаются по обращению
+        header = bytearray(block_space.block_size)
+        block_space.read_data([0], header)
+        superblock = parse_superblock(header)
+        if superblock is None:
+            raise Exception("Образ не отформатирован.")
+        metadata = cls(block_space, superblock)
+        bitmap = block_space.read_range(superblock["bitmap_start"], superblock["bitmap_blocks"], bytearray(
+            superblock["bitmap_blocks"] * block_space.block_size))
+        block_space.load_bitmap(bitmap)
+        inode_bitmap = block_space.read_range(superblock["inode_bitmap_start"], superblock["inode_bitmap_blocks"],
+                                              bytearray(superblock["inode_bitmap_blocks"] * block_space.block_size))
+        metadata.inode_bitmap[:] = inode_bitmap[:len(metadata.inode_bitmap)]
+        metadata.used_inodes = sum(bin(byte).count('1') for byte in metadata.inode_bitmap)
+        if superblock["checksum_blocks"] and block_space.checksums is not None:
+            # Служебные области пишутся через журнал позже сохранения таблицы,
+            # поэтому загружаются только суммы блоков данных
+            data = block_space.read_range(superblock["checksum_start"], superblock["checksum_blocks"], bytearray(
+                superblock["checksum_blocks"] * block_space.block_size), verify=False)
+            block_space.load_checksums(data, metadata.data_start())
+            metadata.saved_checksums = bytes(data[:block_space.total_blocks * 4])
+        return metadata
+
+    def data_start(self):
+        superblock = self.superblock
+        if superblock["checksum_blocks"]:
+            return superblock["checksum_start"] + superblock["checksum_blocks"]
+        return superblock["inode_table_start"] + superblock["inode_table_blocks"]
+
+    def _set_inode_bit(self, inode, used):
+        mask = 1 << (inode & 7)
+        if bool(self.inode_bitmap[inode >> 3] & mask) == used:
+            return
+        if used:
+            self.inode_bitmap[inode >> 3] |= mask
+            self.used_inodes += 1
+        else:
+            self.inode_bitmap[inode >> 3] &= ~mask & 0xFF
+            self.used_inodes -= 1
+
+    def reserve_inode(self):
+        with self.lock:
+            if self.used_inodes + self.reserved_inodes >= self.inode_count:
+                raise Exception("Нет свободных инодов.")
+            self.reserved_inodes += 1
+
+    def unreserve_inode(self):
+        with self.lock:
+            self.reserved_inodes -= 1
+
+    def allocate_inode(self):
+        for byte_index, byte in enumerate(self.inode_bitmap):
+            if byte != 0xFF:
+                for bit in range(8):
+                    inode = (byte_index << 3) + bit
+                    if inode < self.inode_count and not byte >> bit & 1:
+                        self._set_inode_bit(inode, True)
+                        return inode
+        raise Exception("Нет свободных инодов.")
+
+    def _allocate(self, count):
+        extents = self.block_space.allocate_extents(count)
+        self.allocated.extend(extents)
+        return extents
+
+    def _inode_location(self, inode):
+        offset = inode * INODE_SIZE
+        return self.superblock["inode_table_start"] + offset // self.block_size, offset % self.block_size
+
+    def read_inode(self, inode):
+        block, offset = self._inode_location(inode)
+        buffer = bytearray(self.block_size)
+        self.block_space.read_data([block], buffer)
+        return self._unpack_inode(buffer, offset)
+
+    def _unpack_inode(self, buffer, offset):
+        inode_type, flags, extent_count, indirect, size = INODE_HEADER.unpack_from(buffer, offset)
+        extents = []
+        inline = min(extent_count, INLINE_EXTENTS)
+        for i in range(inline):
+            extents.append(EXTENT.unpack_from(buffer, offset + INODE_HEADER.size + i * EXTENT.size))
+        remaining = extent_count - inline
+        block = bytearray(self.block_size)
+        while remaining:
+            self.block_space.read_data([indirect], block)
+            count = self._indirect_count(remaining)
+            for i in range(count):
+                extents.append(EXTENT.unpack_from(block, i * EXTENT.size))
+            remaining -= count
+            if remaining:
+                indirect = EXTENT.unpack_from(block, count * EXTENT.size)[0]
+        return inode_type, size, extents, indirect, flags
+
+    def _indirect_count(self, remaining):
+        # Экстентов в очередном косвенном блоке; в неполном блоке цепочки нет ссылки на следующий
+        return remaining if remaining <= self.indirect_extents else self.indirect_extents - 1
+
+    def _indirect_chain(self, indirect, overflow):
+        # Номера косвенных блоков инода с overflow экстентами сверх помещающихся в инод
+        chain = []
+        block = bytearray(self.block_size)
+        while overflow > 0:
+            chain.append(indirect)
+            count = self._indirect_count(overflow)
+            overflow -= count
+            if overflow:
+                self.block_space.read_data([indirect], block)
+                indirect = EXTENT.unpack_from(block, count * EXTENT.size)[0]
+        return chain
+
+    def _write_inodes(self, records):
+        # records: инод -> (тип, размер, экстенты[, флаги]); иноды одного блока таблицы пишутся вместе
+        by_block = {}
+        for inode, record in records.items():
+            block, offset = self._inode_location(inode)
+            by_block.setdefault(block, []).append((offset, record))
+        buffer = bytearray(self.block_size)
+        for block in sorted(by_block):
+            self.block_space.read_data([block], buffer)
+            for offset, (inode_type, size, extents, *flags) in by_block[block]:
+                _, _, extent_count, indirect, _ = INODE_HEADER.unpack_from(buffer, offset)
+                chain = self._indirect_chain(indirect, extent_count - INLINE_EXTENTS)
+                indirect = self._write_indirect(chain, extents)
+                record = bytearray(INODE_SIZE)
+                INODE_HEADER.pack_into(record, 0, inode_type, flags[0] if flags else 0, len(extents), indirect, size)
+                for i, extent in enumerate(extents[:INLINE_EXTENTS]):
+                    EXTENT.pack_into(record, INODE_HEADER.size + i * EXTENT.size, *extent)
+                buffer[offset:offset + INODE_SIZE] = record
+            self.block_space.write_range(block, buffer)
+
+    def _write_indirect(self, chain, extents):
+        # Запись цепочки косвенных блоков; блоки старой цепочки используются повторно
+        overflow = extents[INLINE_EXTENTS:]
+        counts = []
+        remaining = len(overflow)
+        while remaining:
+            counts.append(self._indirect_count(remaining))
+            remaining -= counts[-1]
+        if len(chain) > len(counts):
+            self.block_space.release_on_commit([(block, 1) for block in chain[len(counts):]])
+            chain = chain[:len(counts)]
+        elif len(chain) < len(counts):
+            allocated = self._allocate(len(counts) - len(chain))
+            if not allocated:
+                raise Exception("Недостаточно свободных блоков.")
+            chain = chain + list(extent_blocks(allocated))
+        block = bytearray(self.block_size)
+        position = 0
+        for i, count in enumerate(counts):
+            block[:] = bytes(self.block_size)
+            for j, extent in enumerate(overflow[position:position + count]):
+                EXTENT.pack_into(block, j * EXTENT.size, *extent)
+            position += count
+            if i + 1 < len(counts):
+                EXTENT.pack_into(block, count * EXTENT.size, chain[i + 1], 0)
+            self.block_space.write_range(chain[i], block)
+        return chain[0] if chain else 0
+
+    def _free_inode(self, inode, inode_type):
+        if inode_type == INODE_DIRECTORY:
+            # Данные файлов освобождает FileSystem, содержимое каталога - метаданные.
+            # Косвенные блоки освобождаются при записи пустого инода
+            self.block_space.release_on_commit(self.read_inode(inode)[2])
+        self._write_inodes({inode: (INODE_FREE, 0, [])})
+        self._set_inode_bit(inode, False)
+
+    def _free_entry(self, path, inode, inode_type):
+        # У удалённого каталога освобождаются и записи, удалённые из него в этом же сеансе
+        if inode_type == INODE_DIRECTORY:
+            for name, (child, child_type) in self.entries.pop(path, {}).items():
+                self._free_entry(os.path.join(path, name), child, child_type)
+            self.dir_inodes.pop(path, None)
+        self._free_inode(inode, inode_type)
+
+    def _write_checksums(self):
+        if not self.superblock["checksum_blocks"] or self.block_space.checksums is None:
+            return
+        data = self.block_space.checksum_bytes()
+        saved = self.saved_checksums
+        start = self.superblock["checksum_start"]
+        for offset in range(0, len(data), self.block_size):
+            chunk = data[offset:offset + self.block_size]
+            if saved is None or saved[offset:offset + self.block_size] != chunk:
+                self.block_space.write_range(start + offset // self.block_size, chunk)
+        self.saved_checksums = data
+
+    def update_file(self, file):
+        # Запись инода уже сохранённого файла и битовых карт (например, после переноса блоков)
+        with self.lock:
+            if "inode" not in file:
+                return
+            self.allocated = []
+            try:
+                self._write_inodes({file["inode"]: (INODE_FILE, file["size"], list(file["extents"]),
+                                                    file.get("compression", 0))})
+                self._write_bitmaps()
+            except Exception:
+                self.block_space.release_extents(self.allocated)
+                raise
+
+    def resize(self, total_blocks):
+        # Новый размер пространства в суперблоке; служебные области остаются на месте
+        with self.lock:
+            self.superblock["total_blocks"] = total_blocks
+            header = bytearray(self.block_size)
+            self.block_space.read_data([0], header)
+            SUPERBLOCK.pack_into(header, 0, *(self.superblock[field] for field in SUPERBLOCK_FIELDS))
+            self.block_space.write_range(0, header)
+            if self.saved_checksums is not None:
+                self.saved_checksums = self.saved_checksums[:total_blocks * 4]
+
+    def _write_bitmaps(self):
+        superblock = self.superblock
+        self.block_space.write_range(superblock["bitmap_start"], self.block_space.bitmap_after_commit())
+        self.block_space.write_range(superblock["inode_bitmap_start"], self.inode_bitmap)
+
+    def _parent_entry(self, path, directories):
+        parent = os.path.dirname(path)
+        if parent == path or parent not in directories:
+            return None
+        return directories[parent].get(os.path.basename(path))
+
+    def load_file(self, path, directories):
+        entry = self._parent_entry(path, directories)
+        if entry is None or entry[0] is None or entry[1] != INODE_FILE:
+            return None
+        inode = entry[0]
+        _, size, extents, _, flags = self.read_inode(inode)
+        return {"size": size, "extents": extents, "position": 0, "block_size": self.block_size, "inode": inode,
+                "compression": flags}
+
+    def load_directory(self, path, directories):
+        if path == "/":
+            inode = ROOT_INODE
+        else:
+            entry = self._parent_entry(path, directories)
+            if entry is None or entry[0] is None or entry[1] != INODE_DIRECTORY:
+                return None
+            inode = entry[0]
+        _, size, extents, _, _ = self.read_inode(inode)
+        data = self._read_extents(extents, size)
+        entries = {}
+        offset = 0
+        while offset < size:
+            child, child_type, name_length = DIRECTORY_ENTRY.unpack_from(data, offset)
+            offset += DIRECTORY_ENTRY.size
+            entries[data[offset:offset + name_length].decode('utf-8')] = (child, child_type)
+            offset += name_length
+        self.entries[path] = dict(entries)
+        self.dir_inodes[path] = inode
+        return entries
+
+    def _read_extents(self, extents, size):
+        data = bytearray(sum(count for _, count in extents) * self.block_size)
+        view = memoryview(data)
+        position = 0
+        for start, count in extents:
+            self.block_space.read_range(start, count, view[position:position + count * self.block_size])
+            position += count * self.block_size
+        return bytes(data[:size])
+
+    def has_name_index(self):
+        return self.superblock["version"] >= 2
+
+    def has_dedup_table(self):
+        return self.superblock["version"] >= 4
+
+    def read_system_file(self, inode):
+        _, size, extents, _, _ = self.read_inode(inode)
+        return self._read_extents(extents, size)
+
+    def _write_directory(self, path, inode, entries):
+        data = bytearray()
+        for name, (child, child_type) in entries.items():
+            encoded = name.encode('utf-8')
+            data += DIRECTORY_ENTRY.pack(child, child_type, len(encoded)) + encoded
+        return self._write_content(inode, INODE_DIRECTORY, data, path in self.entries)
+
+    def _write_content(self, inode, inode_type, data, existing):
+        # Данные служебного инода (каталог, индекс) с перераспределением блоков при смене размера
+        _, _, extents, _, _ = self.read_inode(inode) if existing else (0, 0, [], 0, 0)
+        needed = blocks_for(len(data), self.block_size)
+        if sum(count for _, count in extents) != needed:
+            # Старые блоки ещё нужны сохранённым метаданным и освобождаются после фиксации
+            self.block_space.release_on_commit(extents)
+            extents = self._allocate(needed) if needed else []
+            if needed and not extents:
+                raise Exception("Недостаточно свободных блоков для метаданных.")
+        position = 0
+        for start, count in extents:
+            chunk = data[position:position + count * self.block_size]
+            chunk += bytes(count * self.block_size - len(chunk))
+            self.block_space.write_range(start, chunk)
+            position += count * self.block_size
+        return inode_type, len(data), extents
+
+    def sync(self, files, directories, name_index=None, dedup=None):
+        # При ошибке состояние в памяти возвращается к последнему сохранению,
+        # чтобы после отката транзакции sync можно было повторить
+        with self.lock:
+            state = (dict(self.entries), dict(self.dir_inodes), bytes(self.inode_bitmap), self.used_inodes,
+                     self.reserved_inodes, self.saved_checksums, len(self.block_space.pending_releases),
+                     name_index is not None and name_index.dirty, dedup is not None and dedup.dirty)
+            self.allocated = []
+            assigned = []
+            try:
+                self._sync(files, directories, name_index, dedup, assigned)
+            except Exception:
+                self._restore(state, assigned, files, name_index, dedup)
+                raise
+
+    def _restore(self, state, assigned, files, name_index, dedup):
+        (self.entries, self.dir_inodes, inode_bitmap, self.used_inodes, self.reserved_inodes,
+         self.saved_checksums, released, index_dirty, dedup_dirty) = state
+        self.inode_bitmap[:] = inode_bitmap
+        del self.block_space.pending_releases[released:]
+        self.block_space.release_extents(self.allocated)
+        self.allocated = []
+        for entries, name, path, child_type in assigned:
+            if name in entries:
+                entries[name] = (None, child_type)
+            if child_type == INODE_FILE and dict.__contains__(files, path):
+                dict.__getitem__(files, path).pop("inode", None)
+        if index_dirty:
+            name_index.dirty = True
+        if dedup_dirty:
+            dedup.dirty = True
+
+    def _sync(self, files, directories, name_index, dedup, assigned):
+        # Сохранение загруженных каталогов и инодов файлов, затем битовых карт.
+        # Новые записи каталогов (инод None) получают иноды; записи, пропавшие
+        # по сравнению с сохранённым состоянием, освобождаются
+        records = {}
+        for path, entries in list(dict.items(directories)):
+            old = self.entries.get(path, {})
+            for name, (child, child_type) in list(entries.items()):
+                if child is not None:
+                    continue
+                child = self.allocate_inode()
+                self.reserved_inodes -= 1
+                entries[name] = (child, child_type)
+                assigned.append((entries, name, os.path.join(path, name), child_type))
+                if child_type == INODE_FILE:
+                    files[os.path.join(path, name)]["inode"] = child
+                else:
+                    self.dir_inodes[os.path.join(path, name)] = child
+            for name, (child, child_type) in old.items():
+                if entries.get(name, (None,))[0] != child:
+                    self._free_entry(os.path.join(path, name), child, child_type)
+            if entries != old or path not in self.entries:
+                records[self.dir_inodes[path]] = self._write_directory(path, self.dir_inodes[path], entries)
+            self.entries[path] = dict(entries)
+
+        for file in dict.values(files):
+            records[file["inode"]] = (INODE_FILE, file["size"], list(file["extents"]), file.get("compression", 0))
+        if name_index is not None and name_index.dirty and self.has_name_index():
+            records[INDEX_INODE] = self._write_content(INDEX_INODE, INODE_SYSTEM, name_index.serialize(), True)
+        if dedup is not None and dedup.dirty and self.has_dedup_table():
+            records[DEDUP_INODE] = self._write_content(DEDUP_INODE, INODE_SYSTEM, dedup.serialize(), True)
+        self._write_inodes(records)
+        self._write_bitmaps()
+        self._write_checksums()
+
+class LazyFileTable(dict):
+    # Таблица файлов, подгружающая иноды с диска при первом обращении
+    def __init__(self, metadata, directories):
+        super().__init__()
+        self.metadata = metadata
+        self.directories = directories
+
+    def __missing__(self, path):
+        with self.metadata.lock:
+            if dict.__contains__(self, path):
+                return dict.__getitem__(self, path)
+            file = self.metadata.load_file(path, self.directories)
+            if file is None:
+                raise KeyError(path)
+            dict.__setitem__(self, path, file)
+            return file
+
+    def __contains__(self, path):
+        try:
+            self[path]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, path, default=None):
+        return self[path] if path in self else default
+
+    def pop(self, path, *default):
+        if path in self:
+            return dict.pop(self, path)
+        if default:
+            return default[0]
+        raise KeyError(path)
+
+class LazyDirectoryTable(dict):
+    # Таблица каталогов, читающая записи каталога с диска при первом обращении
+    def __init__(self, metadata):
+        super().__init__()
+        self.metadata = metadata
+
+    def __missing__(self, path):
+        with self.metadata.lock:
+            if dict.__contains__(self, path):
+                return dict.__getitem__(self, path)
+            entries = self.metadata.load_directory(path, self)
+            if entries is None:
+                raise KeyError(path)
+            dict.__setitem__(self, path, entries)
+            return entries
+
+    def __contains__(self, path):
+        try:
+            self[path]
+        except KeyError:
+            return False
+        return True
+
+    def get(self, path, default=None):
+        return self[path] if path in self else default
@@ -0,0 +1,112 @@
+import fnmatch
+import posixpath
+import re
+
+# Индекс имён по триграммам: поиск подстроки и масок без обхода дерева каталогов
+
+GLOB_SPECIAL = re.compile(r'\[[^\]]*\]|[*?]')
+
+def trigrams(text):
+    return {text[i:i + 3] for i in range(len(text) - 2)}
+
+class NameIndex:
+    def __init__(self, loader=None):
+        # loader возвращает сохранённый список путей; до первого поиска изменения копятся
+        self.loader = loader
+        self.loaded = loader is None
+        self.pending = []
+        self.dirty = False
+        self.names = {}
+        self.grams = {}
+
+    def _ensure_loaded(self):
+        if self.loaded:
+            return
+        self.loaded = True
+        for path in self.loader():
+            self._add(path)
+        pending, self.pending = self.pending, []
+        for add, path in pending:
+            self._add(path) if add else self._remove(path)
+
+    def _add(self, path):
+        name = posixpath.basename(path)
+        if path in self.names:
+            return
+        self.names[path] = name
+        for gram in trigrams(name):
+            self.grams.setdefault(gram, set()).add(path)
+
+    def _remove(self, path):
+        name = self.names.pop(path, None)
+        if name is None:
+            return
+        for gram in trigrams(name):
+            paths = self.grams.get(gram)
+            if paths is not None:
+                paths.discard(path)
+                if not paths:
+                    del self.grams[gram]
+
+    def add(self, path):
+        self.dirty = True
+        if self.loaded:
+            self._add(path)
+        else:
+            self.pending.append((True, path))
+
+    def remove(self, path):
+        self.dirty = True
+        if self.loaded:
+            self._remove(path)
+        else:
+            self.pending.append((False, path))
+
+    def _candidates(self, literal):
+        # Пути, имена которых содержат все триграммы literal; None - если триграмм нет
+        grams = trigrams(literal)
+        if not grams:
+            return None
+        sets = sorted((self.grams.get(gram, set()) for gram in grams), key=len)
+        result = set(sets[0])
+        for paths in sets[1:]:
+            result &= paths
+            if not result:
+                break
+        return result
+
+    def search(self, substring):
+        self._ensure_loaded()
+        candidates = self._candidates(substring)
+        if candidates is None:
+            candidates = self.names
+        return sorted(path for path in candidates if substring in self.names[path])
+
+    def match(self, mask, directory=None, names=None):
+        # Имена по маске glob. Если в маске есть литерал из 3+ символов, кандидаты берутся
+        # из индекса; иначе перебираются names (записи каталога) или все имена индекса
+        self._ensure_loaded()
+        literals = [part for part in GLOB_SPECIAL.split(mask) if len(part) >= 3]
+        candidates = self._candidates(max(literals, key=len)) if literals else None
+        if candidates is None:
+            if names is not None and directory is not None:
+                candidates = (posixpath.join(directory, name) for name in names)
+            else:
+                candidates = self.names
+        result = []
+        for path in candidates:
+            if directory is not None and posixpath.dirname(path) != directory:
+                continue
+            name = posixpath.basename(path)
+            if fnmatch.fnmatch(name, mask):
+                result.append(path)
+        return sorted(result)
+
+    def serialize(self):
+        self._ensure_loaded()
+        self.dirty = False
+        return "\n".join(sorted(self.names)).encode("utf-8")
+
+def deserialize(data):
+    text = bytes(data).decode("utf-8")
+    return text.split("\n") if text else []
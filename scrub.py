@@ -0,0 +1,73 @@
+import threading
+import time
+
+from main import block_runs
+
+class BlockScrubber(threading.Thread):
+    # Фоновая проверка контрольных сумм «холодных» блоков - выделенных, но не лежащих
+    # в кеше и журнале. Скорость чтения ограничена rate_mb МБ/с
+    def __init__(self, block_space, rate_mb=4.0, cache=None, batch_blocks=64, interval=60.0):
+        super().__init__(daemon=True)
+        if rate_mb <= 0:
+            raise ValueError("Скорость проверки должна быть положительной.")
+        self.block_space = block_space
+        self.rate_mb = rate_mb
+        self.cache = cache
+        self.batch_blocks = batch_blocks
+        self.interval = interval
+        self.stop_event = threading.Event()
+        self.passes = 0
+        self.scanned_blocks = 0
+        self.skipped_blocks = 0
+        self.damaged_blocks = set()
+        self.busy_seconds = 0.0
+
+    def run(self):
+        while not self.stop_event.is_set():
+            self.scrub_pass()
+            self.stop_event.wait(self.interval)
+
+    def stop(self):
+        self.stop_event.set()
+        if self.is_alive():
+            self.join()
+
+    def _cold(self, block_index):
+        if block_index in self.block_space.wal_pending:
+            return False
+        return self.cache is None or block_index not in self.cache.blocks
+
+    def scrub_pass(self):
+        block_space = self.block_space
+        if block_space.checksums is None:
+            return
+        started = time.perf_counter()
+        scanned_bytes = 0
+        for batch in range(0, block_space.total_blocks, self.batch_blocks):
+            if self.stop_event.is_set():
+                return
+            end = min(batch + self.batch_blocks, block_space.total_blocks)
+            blocks = [block for block in range(batch, end) if block_space.is_allocated(block)]
+            cold = [block for block in blocks if self._cold(block)]
+            self.skipped_blocks += len(blocks) - len(cold)
+            work_started = time.perf_counter()
+            for start, count in block_runs(cold):
+                self.damaged_blocks.update(block_space.scrub_range(start, count))
+                self.scanned_blocks += count
+                scanned_bytes += count * block_space.block_size
+            self.busy_seconds += time.perf_counter() - work_started
+            # Пауза, чтобы средняя скорость прохода не превышала rate_mb
+            ahead = scanned_bytes / (self.rate_mb * 2 ** 20) - (time.perf_counter() - started)
+            if ahead > 0:
+                self.stop_event.wait(ahead)
+        self.passes += 1
+
+    def stats(self):
+        return {
+            'passes': self.passes,
+            'scanned_blocks': self.scanned_blocks,
+            'skipped_blocks': self.skipped_blocks,
+            'damaged_blocks': sorted(self.damaged_blocks),
+            'busy_seconds': self.busy_seconds,
+            'rate_mb': self.rate_mb
+        }
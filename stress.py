@@ -0,0 +1,292 @@
+import io
+import os
+import random
+import sys
+import tempfile
+import threading
+from contextlib import redirect_stdout
+
+from main import BlockSpace, extent_blocks
+from main6 import FileSystem
+from metadata import FileSystemMetadata
+
+# Нагрузочная проверка: распределитель и файловая система под конкурентным доступом
+
+def check_allocator(block_space, owned):
+    # Выделенные потоками блоки не пересекаются, не попадают в свободные экстенты,
+    # совпадают с битовой картой и вместе со свободными покрывают всё пространство
+    used = set()
+    for extents in owned:
+        for block in extent_blocks(extents):
+            if block in used:
+                raise AssertionError(f"Блок {block} выделен дважды.")
+            used.add(block)
+    free = set()
+    previous_end = -1
+    for start, count in block_space.free_extents:
+        if start <= previous_end:
+            raise AssertionError(f"Свободные экстенты пересекаются или не слиты: ({start}, {count}).")
+        previous_end = start + count
+        free.update(range(start, start + count))
+    if used & free:
+        raise AssertionError("Выделенный блок числится свободным.")
+    if len(used) + len(free) != block_space.total_blocks:
+        raise AssertionError("Потеряны блоки.")
+    if free and any(block_space.is_allocated(block) for block in free):
+        raise AssertionError("Битовая карта расходится с индексом свободных экстентов.")
+    if any(not block_space.is_allocated(block) for block in used):
+        raise AssertionError("Битовая карта расходится с выделенными блоками.")
+
+def allocator_stress(block_space, threads=8, iterations=2000, seed=0):
+    owned = [[] for _ in range(threads)]
+    errors = []
+
+    def worker(number):
+        rnd = random.Random(seed + number)
+        mine = owned[number]
+        try:
+            for _ in range(iterations):
+                if mine and rnd.random() < 0.45:
+                    block_space.release_extents([mine.pop(rnd.randrange(len(mine)))])
+                else:
+                    extents = block_space.allocate_extents(rnd.randint(1, 16))
+                    mine.extend(extents)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
+    check_allocator(block_space, [[extent] for extents in owned for extent in extents])
+    return {
+        'threads': threads,
+        'iterations': iterations,
+        'allocated_blocks': sum(count for extents in owned for _, count in extents),
+        'free_extents': len(block_space.free_extents),
+    }
+
+def file_stress(fs, threads=8, iterations=200, seed=0):
+    # Каждый поток пишет и читает свой файл; содержимое сверяется с моделью
+    errors = []
+
+    def worker(number):
+        rnd = random.Random(seed + number)
+        path = f"/stress{number}"
+        model = bytearray()
+        try:
+            fs.create(path)
+            for _ in range(iterations):
+                offset = rnd.randint(0, 4 * fs.block_size)
+                data = rnd.randbytes(rnd.randint(1, 2 * fs.block_size))
+                fs.write(path, offset, data)
+                if len(model) < offset + len(data):
+                    model.extend(bytes(offset + len(data) - len(model)))
+                model[offset:offset + len(data)] = data
+                if fs.read(path, 0, len(model)) != model:
+                    raise AssertionError(f"Содержимое {path} не совпало.")
+            fs.delete_file(path)
+        except Exception as e:
+            errors.append(e)
+
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    for thread in workers:
+        thread.start()
+    for thread in workers:
+        thread.join()
+    if errors:
+        raise errors[0]
+    return {'threads': threads, 'iterations': iterations}
+
+def sync_stress(fs, threads=6, iterations=100, seed=0):
+    # Потоки создают и удаляют файлы и каталоги, пока отдельный поток сохраняет метаданные
+    errors = []
+    done = threading.Event()
+
+    def worker(number):
+        rnd = random.Random(seed + number)
+        mine = []
+        try:
+            fs.create_directory(f"/sync{number}")
+            for i in range(iterations):
+                if mine and rnd.random() < 0.3:
+                    fs.delete_file(mine.pop(rnd.randrange(len(mine))))
+                else:
+                    path = f"/sync{number}/file{i}"
+                    fs.create(path, rnd.randint(0, 2 * fs.block_size))
+                    mine.append(path)
+        except Exception as e:
+            errors.append(e)
+
+    def syncer():
+        try:
+            while not done.is_set():
+                fs.sync()
+        except Exception as e:
+            errors.append(e)
+
+    # Частое переключение потоков, чтобы sync чаще попадал между шагами изменения дерева
+    interval = sys.getswitchinterval()
+    sys.setswitchinterval(1e-6)
+    workers = [threading.Thread(target=worker, args=(number,)) for number in range(threads)]
+    sync_thread = threading.Thread(target=syncer)
+    try:
+        sync_thread.start()
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        done.set()
+        sync_thread.join()
+    finally:
+        sys.setswitchinterval(interval)
+    if errors:
+        raise errors[0]
+    fs.sync()
+    return {'threads': threads, 'iterations': iterations}
+
+def tree_snapshot(fs, directory="/"):
+    return sorted(fs.walk_paths(directory))
+
+def dedup_zero_check(path, size=300 * 1024):
+    # Нулевой файл при дедупликации занимает один блок и один экстент и переживает
+    # сохранение метаданных и перемонтирование
+    with BlockSpace(path, 1024, 4096) as block_space, redirect_stdout(io.StringIO()):
+        fs = FileSystem(block_space, 1024, 64, FileSystemMetadata.format(block_space), dedup=True)
+        fs.create("/zeros")
+        fs.write("/zeros", 0, bytes(size))
+        extents = list(fs.files["/zeros"]["extents"])
+        if len(extents) != 1:
+            raise AssertionError(f"Нулевой файл занял {len(extents)} экстентов.")
+        fs.sync()
+        fs.close()
+    with BlockSpace(path, 1024, 4096) as block_space, redirect_stdout(io.StringIO()):
+        fs = FileSystem(block_space, 1024, 64, FileSystemMetadata.mount(block_space))
+        if fs.files["/zeros"]["extents"] != extents or fs.read("/zeros", 0, size) != bytes(size):
+            raise AssertionError("Нулевой файл не пережил перемонтирование.")
+        fs.write("/zeros", size // 2, b"data")
+        if fs.read("/zeros", size // 2 - 4, 12) != bytes(4) + b"data" + bytes(4):
+            raise AssertionError("Запись в общий блок затронула соседние блоки.")
+        stats = fs.dedup.stats()
+        fs.close()
+    return {'extents': len(extents), 'saved_blocks': stats['saved_blocks']}
+
+def readahead_reuse_check(path, src_path):
+    # Упреждающее чтение, ждущее в занятом пуле, не должно вернуть в кеш блоки удалённого
+    # файла, которые уже заняты новым файлом, записанным мимо кеша
+    with BlockSpace(path, 4096, 256) as block_space, redirect_stdout(io.StringIO()):
+        fs = FileSystem(block_space, 4096, 64, io_workers=1)
+        fs.create("/old")
+        fs.write("/old", 0, bytes(8 * 4096))
+        gate = threading.Event()
+        fs.io_pool().submit(gate.wait)
+        fs.read("/old", 0, 4096)
+        fs.read("/old", 4096, 4096)
+        fs.delete_file("/old")
+        gate.set()
+        fs.io_pool().submit(int).result()
+        data = random.Random(0).randbytes(4 * 4096)
+        with open(src_path, 'wb') as f:
+            f.write(data)
+        fs.import_file(src_path, "/new")
+        if fs.read("/new", 0, len(data)) != data:
+            raise AssertionError("Упреждающее чтение вернуло устаревшие блоки.")
+        stats = fs.cache_stats()
+        fs.close()
+    return {'prefetched_blocks': stats['prefetched_blocks'], 'prefetch_hits': stats['prefetch_hits']}
+
+def sync_failure_check(path, wal_path):
+    # Неудачное сохранение метаданных не теряет каталог: ни авария до фиксации транзакции,
+    # ни повтор sync после отката. Каталог растёт и переезжает на новые блоки
+    def populate(fs, first, count):
+        for i in range(first, first + count):
+            fs.create(f"/d/f{i}")
+            fs.write(f"/d/f{i}", 0, f"file {i}".encode())
+
+    def fail():
+        raise OSError("Сбой записи.")
+
+    def check(expected):
+        with BlockSpace(path, 1024, 4096, wal_filename=wal_path) as block_space, redirect_stdout(io.StringIO()):
+            fs = FileSystem(block_space, 1024, 0, FileSystemMetadata.mount(block_space))
+            if len(fs.directories["/d"]) != expected:
+                raise AssertionError(f"В каталоге {len(fs.directories['/d'])} файлов вместо {expected}.")
+            for i in range(expected):
+                if fs.read(f"/d/f{i}", 0, 16) != f"file {i}".encode():
+                    raise AssertionError(f"Файл /d/f{i} повреждён.")
+            fs.close()
+
+    with BlockSpace(path, 1024, 4096, wal_filename=wal_path) as block_space, redirect_stdout(io.StringIO()):
+        fs = FileSystem(block_space, 1024, 0, FileSystemMetadata.format(block_space))
+        fs.create_directory("/d")
+        populate(fs, 0, 20)
+        fs.sync()
+        populate(fs, 20, 180)
+        fs.metadata._write_checksums = fail
+        try:
+            fs.sync()
+        except OSError:
+            pass
+        else:
+            raise AssertionError("Сбой сохранения не дошёл до вызывающего.")
+        del fs.metadata._write_checksums
+        fs.sync()
+        fs.close()
+    check(200)
+
+    block_space = BlockSpace(path, 1024, 4096, wal_filename=wal_path)
+    with redirect_stdout(io.StringIO()):
+        fs = FileSystem(block_space, 1024, 0, FileSystemMetadata.mount(block_space))
+        populate(fs, 200, 100)
+        block_space.commit_transaction = fail
+        try:
+            fs.sync()
+        except OSError:
+            pass
+    # Авария до фиксации: файлы закрываются без сброса журнала и транзакции
+    block_space.wal.close()
+    block_space._file.close()
+    check(200)
+    return {'files': 200}
+
+def main():
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "stress.bin")
+        with BlockSpace(path, 1024, 4096) as block_space, redirect_stdout(io.StringIO()):
+            allocator_report = allocator_stress(block_space)
+        os.remove(path)
+        with BlockSpace(path, 1024, 4096) as block_space, redirect_stdout(io.StringIO()):
+            fs = FileSystem(block_space, 1024, cache_blocks=64)
+            file_report = file_stress(fs)
+            fs.close()
+            check_allocator(block_space, [])
+        os.remove(path)
+        with BlockSpace(path, 1024, 8192) as block_space, redirect_stdout(io.StringIO()):
+            fs = FileSystem(block_space, 1024, 64, FileSystemMetadata.format(block_space))
+            sync_report = sync_stress(fs)
+            paths = tree_snapshot(fs)
+            fs.close()
+        # После перемонтирования дерево совпадает с сохранённым
+        with BlockSpace(path, 1024, 8192) as block_space, redirect_stdout(io.StringIO()):
+            fs = FileSystem(block_space, 1024, 64, FileSystemMetadata.mount(block_space))
+            if tree_snapshot(fs) != paths:
+                raise AssertionError("Дерево после перемонтирования не совпало.")
+            fs.close()
+        os.remove(path)
+        dedup_report = dedup_zero_check(path)
+        os.remove(path)
+        readahead_report = readahead_reuse_check(path, os.path.join(directory, "source.bin"))
+        os.remove(path)
+        sync_failure_report = sync_failure_check(path, os.path.join(directory, "stress.wal"))
+    print("Распределитель:", allocator_report)
+    print("Файловая система:", file_report)
+    print("Сохранение метаданных:", sync_report)
+    print("Дедупликация нулевого файла:", dedup_report)
+    print("Упреждающее чтение:", readahead_report)
+    print("Сбой сохранения метаданных:", sync_failure_report)
+
+if __name__ == "__main__":
+    main()
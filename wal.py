@@ -0,0 +1,74 @@
+import os
+import struct
+import zlib
+
+# Запись журнала: сигнатура, номер транзакции, номер блока, длина данных, CRC32 данных
+RECORD_HEADER = struct.Struct('<4sQQII')
+BLOCK_RECORD = b'WBLK'
+COMMIT_RECORD = b'WCMT'
+
+class WriteAheadLog:
+    def __init__(self, filename, group_commit=1):
+        if group_commit < 1:
+            raise ValueError("group_commit должен быть не меньше 1.")
+        self.filename = filename
+        self.group_commit = group_commit
+        self.unsynced_commits = 0
+        self._file = open(filename, 'a+b')
+
+    def close(self):
+        if self._file is None:
+            return
+        self.sync()
+        self._file.close()
+        self._file = None
+
+    def append_transaction(self, txid, blocks):
+        # Грязные блоки дописываются последовательно, затем запись фиксации.
+        # Возвращает True, если после этой транзакции журнал сброшен на диск.
+        for block_index in sorted(blocks):
+            data = blocks[block_index]
+            self._file.write(RECORD_HEADER.pack(BLOCK_RECORD, txid, block_index, len(data), zlib.crc32(data)))
+            self._file.write(data)
+        self._file.write(RECORD_HEADER.pack(COMMIT_RECORD, txid, 0, 0, 0))
+        self.unsynced_commits += 1
+        if self.unsynced_commits >= self.group_commit:
+            self.sync()
+            return True
+        return False
+
+    def sync(self):
+        if self._file is None or not self.unsynced_commits:
+            return
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.unsynced_commits = 0
+
+    def replay(self):
+        # Зафиксированные транзакции по порядку: [(txid, {block_index: data})].
+        # Чтение останавливается на первой неполной или повреждённой записи.
+        self._file.flush()
+        committed = []
+        open_transactions = {}
+        with open(self.filename, 'rb') as f:
+            while True:
+                header = f.read(RECORD_HEADER.size)
+                if len(header) < RECORD_HEADER.size:
+                    break
+                magic, txid, block_index, length, crc = RECORD_HEADER.unpack(header)
+                if magic == BLOCK_RECORD:
+                    data = f.read(length)
+                    if len(data) < length or zlib.crc32(data) != crc:
+                        break
+                    open_transactions.setdefault(txid, {})[block_index] = data
+                elif magic == COMMIT_RECORD:
+                    committed.append((txid, open_transactions.pop(txid, {})))
+                else:
+                    break
+        return committed
+
+    def reset(self):
+        self._file.truncate(0)
+        self._file.flush()
+        os.fsync(self._file.fileno())
+        self.unsynced_commits = 0